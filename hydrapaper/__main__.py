@@ -17,46 +17,67 @@
 
 import sys
 import os
+import copy
+import time
+import threading
 import pathlib
-import json
+
+STARTUP_TIME = time.monotonic()
 
 import argparse
-from gi.repository import Gtk, Wnck, Gdk, Gio, GdkPixbuf
+# Wnck is imported by the functions using it, it's slow to load
+from gi.repository import Gtk, Gio, GLib
 
 from . import monitor_parser as MonitorParser
 from . import wallpaper_merger as WallpaperMerger
-from . import threading_helper as ThreadingHelper
+from . import task_scheduler as TaskScheduler
 from . import listbox_helper as ListboxHelper
 from . import wallpaper_flowbox_item as WallpaperFlowboxItem
 from . import wallpapers_folder_listbox_row as WallpapersFolderListBoxRow
-
-import hashlib # for pseudo-random wallpaper name generation
-
-
-HOME = os.environ.get('HOME')
-G_CONFIG_FILE_PATH = '{0}/.config/hydrapaper.json'.format(HOME)
-HYDRAPAPER_CACHE_PATH = '{0}/.cache/hydrapaper'.format(HOME)
-
-# check if inside flatpak sandbox. if so change some variables
-if 'XDG_RUNTIME_DIR' in os.environ.keys():
-    if os.path.isfile('{0}/flatpak-info'.format(os.environ['XDG_RUNTIME_DIR'])):
-        G_CONFIG_FILE_PATH = '{0}/hydrapaper.json'.format(os.environ.get('XDG_CONFIG_HOME'))
-        HYDRAPAPER_CACHE_PATH = '{0}/hydrapaper'.format(os.environ.get('XDG_CACHE_HOME'))
-
-IMAGE_EXTENSIONS = [
-    '.jpg',
-    '.jpeg',
-    '.png',
-    '.tiff',
-    '.svg'
+from . import thumbnail_cache as ThumbnailCache
+from . import thumbnail_loader as ThumbnailLoader
+from . import viewport_thumbnail_loader as ViewportThumbnailLoader
+from . import merge_cache as MergeCache
+from . import wallpaper_scanner as WallpaperScanner
+from . import library_index as LibraryIndex
+from . import folder_watcher as FolderWatcher
+from . import wallpaper_visibility_index as WallpaperVisibilityIndex
+from . import wallpaper_model as WallpaperModel
+from . import config_store as ConfigStore
+from . import favorites_store as FavoritesStore
+from . import profiling as Profiling
+from . import monitor_preview as MonitorPreview
+
+
+G_CONFIG_FILE_PATH = ConfigStore.CONFIG_FILE_PATH
+HYDRAPAPER_CACHE_PATH = ConfigStore.CACHE_PATH
+
+UI_RESOURCE_PATH = '/org/gabmus/hydrapaper/ui/ui.glade'
+# the objects built at startup, everything else is built when first used
+MAIN_UI_OBJECTS = [
+    'window',
+    'wallpapersFlowboxItemoptionsPopover',
+    'wallpapersFoldersActionbarButtonbox',
+    'wallpapersFoldersPopover'
 ]
+# object id -> the toplevel objects to build for it
+LAZY_UI_OBJECTS = {
+    'aboutdialog': ['aboutdialog'],
+    'settingsWindow': ['settingsWindow'],
+    'wallpaperSelectionModeToggle': ['settingsWindow'],
+    'keepFavoritesInMainviewToggle': ['settingsWindow'],
+    'addFolderFileChooserDialog': ['addFolderFileChooserDialog', 'filefilterFolders'],
+    'pathAlreadyAddedInfobarLikeRevealer': ['addFolderFileChooserDialog', 'filefilterFolders']
+}
 
 
 class Application(Gtk.Application):
     def __init__(self, **kwargs):
-        self.builder = Gtk.Builder.new_from_resource(
-            '/org/gabmus/hydrapaper/ui/ui.glade'
-        )
+        self.startup_timer = Profiling.StartupTimer(STARTUP_TIME)
+        self.startup_timer.mark('imports')
+        self.builder = Gtk.Builder()
+        self.builder.add_objects_from_resource(UI_RESOURCE_PATH, MAIN_UI_OBJECTS)
+        self.startup_timer.mark('ui')
         super().__init__(
             application_id='org.gabmus.hydrapaper',
             flags=Gio.ApplicationFlags.HANDLES_COMMAND_LINE,
@@ -66,7 +87,48 @@ class Application(Gtk.Application):
 
         self.CONFIG_FILE_PATH = G_CONFIG_FILE_PATH  # G stands for Global (variable)
 
-        self.configuration = self.get_config_file()
+        self.config_store = ConfigStore.ConfigStore(self.CONFIG_FILE_PATH)
+        self.configuration = self.config_store.load()
+        self.favorites = FavoritesStore.FavoritesStore(self.configuration)
+        self.config_store.add_flush_callback(self.favorites.sync_to_config)
+
+        self.thumbnail_cache = ThumbnailCache.ThumbnailCache(
+            HYDRAPAPER_CACHE_PATH,
+            self.configuration['thumbnail_cache_max_size_mb']
+        )
+        self.thumbnail_loader = ThumbnailLoader.ThumbnailLoader(
+            self.thumbnail_cache
+        )
+        self.task_scheduler = TaskScheduler.TaskScheduler()
+        self.folder_watcher = FolderWatcher.FolderWatcher(
+            self.on_wallpapers_folders_changed
+        )
+        self.visibility_index = WallpaperVisibilityIndex.WallpaperVisibilityIndex(
+            self.configuration,
+            self.favorites
+        )
+        self.merge_cache = MergeCache.MergeCache(
+            HYDRAPAPER_CACHE_PATH,
+            self.configuration['merge_cache_max_size_mb'],
+            self.configuration['merge_cache_max_age_days'],
+            WallpaperMerger.get_current_wallpapers
+        )
+        # fitted per-monitor tiles, so that changing one monitor's
+        # wallpaper doesn't re-fit all the others
+        self.tile_cache = WallpaperMerger.TileCache()
+        # the speculative merge of the current selection, see queue_prerender
+        self.prerender_task = None
+        self.prerender_cancelled = threading.Event()
+        # monitor name -> preview widgets, thumbnail pixbuf and pending
+        # thumbnail task, see set_monitor_wallpaper_preview
+        self.monitor_preview_images = {}
+        self.monitor_preview_pixbufs = {}
+        self.monitor_preview_tasks = {}
+        self.library_index = LibraryIndex.LibraryIndex(
+            HYDRAPAPER_CACHE_PATH,
+            self.thumbnail_cache
+        )
+        self.startup_timer.mark('config and caches')
 
         self.builder.connect_signals(self)
 
@@ -76,6 +138,7 @@ class Application(Gtk.Application):
         self.window = self.builder.get_object('window')
 
         self.window.set_icon_name('org.gabmus.hydrapaper')
+        self.window.connect('focus-in-event', self.on_window_focus_in_event)
 
         self.window.resize(
             self.configuration['windowsize']['width'],
@@ -94,19 +157,42 @@ class Application(Gtk.Application):
         self.apply_spinner = self.builder.get_object('applySpinner')
 
         self.monitors_flowbox = self.builder.get_object('monitorsFlowbox')
+        # the whole spanned wallpaper, scaled down, under the monitors
+        self.layout_preview_image = Gtk.Image()
+        self.layout_preview_image.set_no_show_all(True)
+        self.layout_preview_image.set_margin_top(6)
+        self.layout_preview_image.set_margin_bottom(6)
+        self.mainBox.pack_start(self.layout_preview_image, False, False, 0)
+        self.mainBox.reorder_child(self.layout_preview_image, 1)
         self.wallpapers_flowbox = self.builder.get_object('wallpapersFlowbox')
         self.wallpapers_flowbox_favorites = self.builder.get_object('wallpapersFlowboxFavorites')
 
-        self.keep_favorites_in_mainview_toggle = self.builder.get_object('keepFavoritesInMainviewToggle')
-
-        self.keep_favorites_in_mainview_toggle.set_active(
-            self.configuration['favorites_in_mainview']
+        # both flowboxes are views on the same store, widgets only exist
+        # for the wallpapers a view actually shows
+        self.wallpapers_store = Gio.ListStore.new(WallpaperModel.WallpaperItem)
+        self.wallpapers_model = WallpaperModel.WallpaperFilterModel(
+            self.wallpapers_store,
+            lambda item: self.visibility_index.is_visible(item, False)
+        )
+        self.wallpapers_favorites_model = WallpaperModel.WallpaperFilterModel(
+            self.wallpapers_store,
+            lambda item: self.visibility_index.is_visible(item, True)
+        )
+        self.wallpapers_flowbox.bind_model(
+            self.wallpapers_model,
+            self.make_wallpapers_flowbox_item
+        )
+        self.wallpapers_flowbox_favorites.bind_model(
+            self.wallpapers_favorites_model,
+            self.make_wallpapers_flowbox_item
         )
 
-        self.wallpaper_selection_mode_toggle = self.builder.get_object('wallpaperSelectionModeToggle')
-
-        self.wallpaper_selection_mode_toggle.set_active(
-            not self.configuration['selection_mode'] == 'single'
+        # thumbnails are only decoded for children close to the visible area
+        self.wallpapers_flowbox_thumbnails = ViewportThumbnailLoader.ViewportThumbnailLoader(
+            self.wallpapers_flowbox
+        )
+        self.wallpapers_flowbox_favorites_thumbnails = ViewportThumbnailLoader.ViewportThumbnailLoader(
+            self.wallpapers_flowbox_favorites
         )
 
         self.add_to_favorites_toggle = self.builder.get_object('addToFavoritesButton')
@@ -165,6 +251,41 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
         self.wallpapers_folders_toggle = self.builder.get_object('wallpapersFoldersToggle')
         self.wallpapers_folders_popover = self.builder.get_object('wallpapersFoldersPopover')
         self.wallpapers_folders_popover_listbox = self.builder.get_object('wallpapersFoldersPopoverListbox')
+        self.startup_timer.mark('window')
+
+    def get_lazy_object(self, object_id):
+        # builds the secondary windows and dialogs the first time they're needed
+        ui_object = self.builder.get_object(object_id)
+        if ui_object:
+            return ui_object
+        self.builder.add_objects_from_resource(
+            UI_RESOURCE_PATH, LAZY_UI_OBJECTS[object_id]
+        )
+        # only connects the signals of the objects just built
+        self.builder.connect_signals(self)
+        for toplevel_id in LAZY_UI_OBJECTS[object_id]:
+            setup_func = getattr(self, 'setup_{0}'.format(toplevel_id), None)
+            if setup_func:
+                setup_func(self.builder.get_object(toplevel_id))
+        return self.builder.get_object(object_id)
+
+    def setup_aboutdialog(self, aboutdialog):
+        aboutdialog.connect(
+            "delete-event", lambda *_:
+                aboutdialog.hide() or True
+        )
+
+    def setup_settingsWindow(self, settings_window):
+        settings_window.connect(
+            "delete-event", lambda *_:
+                settings_window.hide() or True
+        )
+        self.builder.get_object('keepFavoritesInMainviewToggle').set_active(
+            self.configuration['favorites_in_mainview']
+        )
+        self.builder.get_object('wallpaperSelectionModeToggle').set_active(
+            not self.configuration['selection_mode'] == 'single'
+        )
 
     def on_window_size_allocate(self, *args):
         alloc = self.window.get_allocation()
@@ -172,100 +293,35 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
         self.configuration['windowsize']['height'] = alloc.height
 
     def do_before_quit(self):
+        self.folder_watcher.stop()
+        self.thumbnail_loader.shutdown()
+        self.cancel_prerender()
+        # the workers may still be using the library index
+        self.task_scheduler.shutdown(wait=True)
+        self.library_index.close()
         self.unminimize_all_other_windows()
-        self.save_config_file()
+        self.config_store.flush()
+        Profiling.profiler.save()
 
     def sync_monitors_from_config(self):
+        # for the command line, which can't ask Gdk
+        self.configuration['monitors_layout'] = [m.to_dict() for m in self.monitors]
         for m in self.monitors:
             if m.name in self.configuration['monitors'].keys():
                 m.wallpaper = self.configuration['monitors'][m.name]
             else:
                 self.configuration['monitors'][m.name] = m.wallpaper
-        self.save_config_file(self.configuration)
+        self.save_config_file()
 
     def dump_monitors_to_config(self):
         for m in self.monitors:
             if m.name in self.configuration['monitors'].keys():
                 self.configuration['monitors'][m.name] = m.wallpaper
-        self.save_config_file(self.configuration)
-
-    def save_config_file(self, n_config=None):
-        if not n_config:
-            n_config = self.configuration
-        with open(self.CONFIG_FILE_PATH, 'w') as fd:
-            fd.write(json.dumps(n_config))
-            fd.close()
-
-    def get_config_file(self):
-        if not os.path.isfile(self.CONFIG_FILE_PATH):
-            n_config = {
-                'wallpapers_paths': [
-                    {
-                        'path': '{0}/Pictures'.format(HOME),
-                        'active': True
-                    },
-                    {
-                        'path': '/usr/share/backgrounds/gnome/',
-                        'active': True
-                    }
-                ],
-                'selection_mode': 'single',
-                'monitors': {},
-                'favorites': [],
-                'favorites_in_mainview': False,
-                'windowsize': {
-                    'width': 600,
-                    'height': 400
-                },
-            }
-            self.save_config_file(n_config)
-            return n_config
-        else:
-            do_save = False
-            with open(self.CONFIG_FILE_PATH, 'r') as fd:
-                config = json.loads(fd.read())
-                fd.close()
-                if not 'wallpapers_paths' in config.keys():
-                    config['wallpapers_paths'] = [
-                    {
-                        'path': '{0}/Pictures'.format(HOME),
-                        'active': True
-                    },
-                    {
-                        'path': '/usr/share/backgrounds/gnome/',
-                        'active': True
-                    }
-                ]
-                    do_save = True
-                if len(config['wallpapers_paths']) > 0:
-                    for index, path in enumerate(config['wallpapers_paths']):
-                        if type(path) == str:
-                            config['wallpapers_paths'][index] = {
-                                'path': path,
-                                'active': True
-                            }
-                    do_save = True
-                if not 'selection_mode' in config.keys():
-                    config['selection_mode'] = 'single'
-                    do_save = True
-                if not 'monitors' in config.keys():
-                    config['monitors'] = {}
-                    do_save = True
-                if not 'favorites' in config.keys():
-                    config['favorites'] = []
-                    do_save = True
-                if not 'favorites_in_mainview' in config.keys():
-                    config['favorites_in_mainview'] = False
-                    do_save = True
-                if not 'windowsize' in config.keys():
-                    config['windowsize'] = {
-                        'width': 600,
-                        'height': 400
-                    }
-                    do_save = True
-                if do_save:
-                    self.save_config_file(config)
-                return config
+        self.save_config_file()
+
+    def save_config_file(self):
+        # batched, the file gets written shortly after the last change
+        self.config_store.save()
 
     def remove_wallpaper_folder(self, btn):
         row=self.wallpapers_folders_popover_listbox.get_selected_row()
@@ -309,7 +365,10 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
                 break
         self.save_config_file()
         #self.refresh_wallpapers_flowbox()
-        self.show_hide_wallpapers()
+        self.visibility_index.set_folder_active(check.value, check.get_active())
+        self.update_wallpapers_visibility(
+            self.visibility_index.get_folder_items(check.value)
+        )
 
     def fill_wallpapers_folders_popover_listbox(self):
         ListboxHelper.empty_listbox(self.wallpapers_folders_popover_listbox)
@@ -323,159 +382,270 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
             )
         self.wallpapers_folders_popover_listbox.show_all()
 
-    def set_monitor_wallpaper_preview(self, wp_path):
-        monitor_widgets = self.monitors_flowbox.get_selected_children()[0].get_children()[0].get_children()
-        for w in monitor_widgets:
-            if type(w) == Gtk.Image:
-                m_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(wp_path, 64, 64, True)
-                w.set_from_pixbuf(m_pixbuf)
-            elif type(w) == Gtk.Label:
-                current_m_name = w.get_text()
-                for m in self.monitors:
-                    if m.name == current_m_name:
-                        m.wallpaper = wp_path
+    def set_monitor_wallpaper_preview(self, wp_path, thumbnail_pixbuf=None):
+        selected = self.monitors_flowbox.get_selected_children()
+        if not selected:
+            return
+        monitor = selected[0].get_child().monitor
+        monitor.wallpaper = wp_path
+        self.load_monitor_preview(monitor, thumbnail_pixbuf)
+
+    def load_monitor_preview(self, monitor, thumbnail_pixbuf=None):
+        '''
+        Previews are scaled from the grid thumbnail: the one already
+        decoded if given, else the cached one, decoded in the background.
+        '''
+        pending = self.monitor_preview_tasks.pop(monitor.name, None)
+        if pending:
+            pending.cancel()
+        if thumbnail_pixbuf:
+            self.on_monitor_preview_ready(monitor.name, monitor.wallpaper, thumbnail_pixbuf)
+            return
+        self.monitor_preview_pixbufs.pop(monitor.name, None)
+        if not monitor.wallpaper or not self.check_if_image(monitor.wallpaper):
+            self.monitor_preview_images[monitor.name].set_from_icon_name(
+                'image-missing', Gtk.IconSize.DIALOG
+            )
+            self.update_layout_preview()
+            return
+        self.monitor_preview_images[monitor.name].set_from_icon_name(
+            'image-x-generic', Gtk.IconSize.DIALOG
+        )
+        wp_path = monitor.wallpaper
+        self.monitor_preview_tasks[monitor.name] = self.thumbnail_loader.request(
+            wp_path,
+            lambda pixbuf: self.on_monitor_preview_ready(monitor.name, wp_path, pixbuf),
+            TaskScheduler.PRIORITY_HIGH
+        )
+
+    def on_monitor_preview_ready(self, monitor_name, wp_path, pixbuf):
+        self.monitor_preview_tasks.pop(monitor_name, None)
+        current = [m for m in self.monitors if m.name == monitor_name]
+        if not current or current[0].wallpaper != wp_path:
+            return  # the selection changed meanwhile
+        if not pixbuf:
+            self.monitor_preview_images[monitor_name].set_from_icon_name(
+                'image-missing', Gtk.IconSize.DIALOG
+            )
+        else:
+            self.monitor_preview_pixbufs[monitor_name] = pixbuf
+            self.monitor_preview_images[monitor_name].set_from_pixbuf(
+                MonitorPreview.scale_to_fit(pixbuf)
+            )
+        self.update_layout_preview()
+
+    def update_layout_preview(self):
+        if len(self.monitors) < 2:
+            # nothing is merged, the monitor preview says it all
+            self.layout_preview_image.hide()
+            return
+        with Profiling.span('render layout preview'):
+            layout_pixbuf = MonitorPreview.render_layout_preview(
+                self.monitors, self.monitor_preview_pixbufs
+            )
+        self.layout_preview_image.set_from_pixbuf(layout_pixbuf)
+        self.layout_preview_image.show()
 
     def make_monitors_flowbox_item(self, monitor):
         box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box.monitor = monitor
         label = Gtk.Label()
         label.set_text(monitor.name)
         image = Gtk.Image()
-        if monitor.wallpaper and self.check_if_image(monitor.wallpaper):
-            m_pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(monitor.wallpaper, 64, 64, True)
-            image.set_from_pixbuf(m_pixbuf)
-        else:
-            image.set_from_icon_name('image-missing', Gtk.IconSize.DIALOG)
+        self.monitor_preview_images[monitor.name] = image
         box.pack_start(image, False, False, 0)
         box.pack_start(label, False, False, 0)
         box.set_margin_left(24)
         box.set_margin_right(24)
         return box
 
-    def make_wallpapers_flowbox_item(self, wp_path):
-        return WallpaperFlowboxItem.WallpaperBox(wp_path)
+    def make_wallpapers_flowbox_item(self, item):
+        widget = WallpaperFlowboxItem.WallpaperBox(
+            item.wallpaper_path, self.thumbnail_loader
+        )
+        widget.set_fav(self.visibility_index.is_favorite(item.wallpaper_path))
+        widget.show_all()
+        return widget
 
     def fill_monitors_flowbox(self):
         for m in self.monitors:
             self.monitors_flowbox.insert(
                 self.make_monitors_flowbox_item(m),
             -1) # -1 appends to the end
-
-    def evaluate_wallpaper_visibility(self, wp_widget, flowbox):
-        visibility = False
-        exists_in_folder = False
-        for folder in self.configuration['wallpapers_paths']:
-            if folder['path'] in wp_widget.wallpaper_path:
-                exists_in_folder = True
-                if folder['active']:
-                    visibility = True
-                else:
-                    return False
-                break
-        if exists_in_folder:
-            visibility = True
-        else:
-            return False
-        if flowbox == self.wallpapers_flowbox:
-            if wp_widget.wallpaper_path in self.configuration['favorites']:
-                if self.configuration['favorites_in_mainview']:
-                    visibility = True
-                else:
-                    return False
-            else:
-                visibility = True
-        else:
-            if wp_widget.wallpaper_path in self.configuration['favorites']:
-                visibility = True
-            else:
-                return False
-        return visibility
-
-    def show_hide_wallpapers(self):
-        for wp_widget in self.wallpapers_flowbox.get_children():
-            if self.evaluate_wallpaper_visibility(wp_widget, self.wallpapers_flowbox):
-                wp_widget.show_all()
-            else:
-                wp_widget.hide()
-        for wp_widget in self.wallpapers_flowbox_favorites.get_children():
-            if self.evaluate_wallpaper_visibility(wp_widget, self.wallpapers_flowbox_favorites):
-                wp_widget.show_all()
-            else:
-                wp_widget.hide()
-
-    def fill_wallpapers_flowbox(self): # called by self.refresh_wallpapers_flowbox
-        for w in self.wallpapers_list:
-            if self.check_if_image(w):
-                widget = self.make_wallpapers_flowbox_item(w)
-                if w in self.configuration['favorites']:
-                    widget.set_fav(True)
-                else:
-                    widget.set_fav(False)
-                self.wallpapers_flowbox.insert(widget, -1) # -1 appends to the end
-                if w in self.configuration['favorites']:
-                    widget_c = self.make_wallpapers_flowbox_item(w)
-                    widget_c.set_fav(True)
-                    self.wallpapers_flowbox_favorites.insert(widget_c, -1)
-                    widget_c.show_all()
-                    self.wallpapers_flowbox_favorites.show_all()
-                widget.show_all()
-                self.wallpapers_flowbox.show_all()
-        for wb in self.wallpapers_flowbox_favorites.get_children():
-            wb.set_wallpaper_thumb()
-        for wb in self.wallpapers_flowbox.get_children():
-            wb.set_wallpaper_thumb()
+        for m in self.monitors:
+            self.load_monitor_preview(m)
+
+    def update_wallpapers_visibility(self, items, rebuild=False):
+        self.wallpapers_model.refilter(items, rebuild)
+        self.wallpapers_favorites_model.refilter(items, rebuild)
+        self.wallpapers_flowbox_thumbnails.invalidate_layout()
+        self.wallpapers_flowbox_favorites_thumbnails.invalidate_layout()
+
+    def get_wallpaper_widgets(self, item):
+        # the widgets currently showing item, in either flowbox
+        widgets = []
+        for model, flowbox in (
+                (self.wallpapers_model, self.wallpapers_flowbox),
+                (self.wallpapers_favorites_model, self.wallpapers_flowbox_favorites)
+        ):
+            position = model.get_position(item)
+            if position is not None:
+                widgets.append(flowbox.get_child_at_index(position))
+        return widgets
+
+    def fill_wallpapers_flowbox(self, wallpapers): # called by self.refresh_wallpapers_flowbox
+        items = [WallpaperModel.WallpaperItem(w) for w in wallpapers]
+        for item in items:
+            self.visibility_index.add(item)
+        # a single items-changed for the whole batch
+        self.wallpapers_store.splice(self.wallpapers_store.get_n_items(), 0, items)
+        # thumbnails get loaded on demand by the viewport thumbnail loaders
+        self.wallpapers_flowbox_thumbnails.invalidate_layout()
+        self.wallpapers_flowbox_favorites_thumbnails.invalidate_layout()
+
+    def remove_wallpaper_items(self, items):
+        # positions are all looked up before removing anything, every
+        # removal invalidates the model's position index
+        positions = sorted(set(
+            p for p in (
+                self.wallpapers_model.get_source_position(item) for item in items
+            ) if p is not None
+        ), reverse=True)
+        # one splice per run of consecutive positions, from the end so
+        # that the positions still to remove don't shift
+        i = 0
+        while i < len(positions):
+            end = start = positions[i]
+            i += 1
+            while i < len(positions) and positions[i] == start - 1:
+                start = positions[i]
+                i += 1
+            self.wallpapers_store.splice(start, end - start + 1, [])
 
     def check_if_image(self, pic):
-        im_path = pathlib.Path(pic)
-        return (
-            im_path.suffix.lower() in IMAGE_EXTENSIONS and
-            im_path.exists() and
-            not im_path.is_dir()
-        )
+        return WallpaperScanner.is_image_filename(pic) and os.path.isfile(pic)
 
     def get_wallpapers_list(self, *args):
-        for path_dict in self.configuration['wallpapers_paths']:
-            folder = path_dict['path']
-            if os.path.isdir(folder): # trying to just hide wallpapers in non active paths # and path_dict['active']:
-                pictures = os.listdir(folder)
-                for pic in pictures:
-                    picpath = '{0}/{1}'.format(folder, pic)
-                    if not self.check_if_image(picpath):
-                        pictures.pop(pictures.index(pic))
-                self.wallpapers_list.extend(['{0}/'.format(folder) + pic for pic in pictures])
+        # runs in a worker thread, streams batches of wallpapers to the
+        # main loop as they are found and returns the last partial batch
+        def on_batch(batch):
+            TaskScheduler.idle_add(
+                self.on_wallpapers_batch, batch,
+                priority=TaskScheduler.PRIORITY_HIGH
+            )
+        # only the folders that changed since the last run get listed
+        with Profiling.operation('library scan'):
+            return self.library_index.scan(
+                # trying to just hide wallpapers in non active paths # and path_dict['active']:
+                [path_dict['path'] for path_dict in self.configuration['wallpapers_paths']],
+                self.configuration['recursive_scan'],
+                on_batch
+            )
+
+    def on_wallpapers_batch(self, batch):
+        with Profiling.span('fill wallpapers flowbox', wallpapers=len(batch)):
+            self.wallpapers_list.extend(batch)
+            self.fill_wallpapers_flowbox(batch)
 
     def empty_wallpapers_flowbox(self):
         self.wallpapers_list = []
-        while True:
-            item = self.wallpapers_flowbox.get_child_at_index(0)
-            if item:
-                self.wallpapers_flowbox.remove(item)
-                item.destroy()
-            else:
-                break
-        while True:
-            item = self.wallpapers_flowbox_favorites.get_child_at_index(0)
-            if item:
-                self.wallpapers_flowbox_favorites.remove(item)
-                item.destroy()
-            else:
-                break
+        self.wallpapers_store.remove_all()
+        self.visibility_index.clear()
 
     def refresh_wallpapers_flowbox(self):
         if self.wallpapers_refreshing_locked:
             return
         self.wallpapers_refreshing_locked = True
+        # the refresh ends in on_wallpapers_list_ready
+        self.refresh_start_time = Profiling.now()
         self.all_wallpaper_folder_interactives_set_sensitive(False)
         self.empty_wallpapers_flowbox()
         # if len(self.configuration['favorites']) == 0:
         #     self.favorites_box.hide()
         # else:
         #     self.favorites_box.show_all()
-        get_wallpapers_thread = ThreadingHelper.do_async(self.get_wallpapers_list, (0,))
-        ThreadingHelper.wait_for_thread(get_wallpapers_thread)
-        self.fill_wallpapers_flowbox()
-        self.show_hide_wallpapers()
+        self.task_scheduler.submit(
+            self.get_wallpapers_list,
+            callback=self.on_wallpapers_list_ready,
+            error_callback=self.on_wallpapers_list_error,
+            priority=TaskScheduler.PRIORITY_HIGH
+        )
+
+    def on_wallpapers_list_ready(self, last_batch):
+        self.on_wallpapers_batch(last_batch)
+        self.task_scheduler.submit(
+            self.library_index.fill_missing_dimensions,
+            priority=TaskScheduler.PRIORITY_LOW
+        )
+        self.wallpapers_refreshing_locked = False
+        self.all_wallpaper_folder_interactives_set_sensitive(True)
+        self.watch_wallpapers_folders()
+        Profiling.profiler.add_complete_event(
+            'refresh wallpapers', self.refresh_start_time, Profiling.now(),
+            {'wallpapers': len(self.wallpapers_list)}
+        )
+        self.startup_timer.mark('library scan')
+        self.startup_timer.report()
+
+    def on_wallpapers_list_error(self, exc):
+        print('Error: could not list wallpapers: {0}'.format(exc))
         self.wallpapers_refreshing_locked = False
         self.all_wallpaper_folder_interactives_set_sensitive(True)
+        self.watch_wallpapers_folders()
+
+    def watch_wallpapers_folders(self):
+        # inactive folders are watched too, their wallpapers are only hidden
+        self.folder_watcher.watch(
+            [path_dict['path'] for path_dict in self.configuration['wallpapers_paths']]
+        )
+
+    def on_wallpapers_folders_changed(self, added, removed):
+        if self.wallpapers_refreshing_locked:
+            # try again once the refresh is done
+            self.folder_watcher.queue(added, removed)
+            return
+        removed = set(removed)
+        # known paths written again, e.g. overwritten
+        changed = [
+            wp_path for wp_path in added
+            if self.visibility_index.get_item(wp_path) and os.path.isfile(wp_path)
+        ]
+        added = [
+            wp_path for wp_path in added
+            if not self.visibility_index.get_item(wp_path) and os.path.isfile(wp_path)
+        ]
+        removed = {
+            wp_path for wp_path in removed
+            if self.visibility_index.get_item(wp_path)
+        }
+        for wp_path in removed:
+            self.library_index.remove_wallpaper(wp_path)
+        for wp_path in added:
+            self.library_index.add_wallpaper(wp_path)
+        if changed:
+            for wp_path in changed:
+                self.library_index.add_wallpaper(wp_path)
+                # the viewport thumbnail loaders decode it again
+                for widget in self.get_wallpaper_widgets(
+                        self.visibility_index.get_item(wp_path)
+                ):
+                    widget.unload_wallpaper_thumb()
+            self.wallpapers_flowbox_thumbnails.invalidate_layout()
+            self.wallpapers_flowbox_favorites_thumbnails.invalidate_layout()
+        if removed:
+            self.wallpapers_list = [
+                wp_path for wp_path in self.wallpapers_list
+                if wp_path not in removed
+            ]
+            items = [self.visibility_index.get_item(wp_path) for wp_path in removed]
+            self.remove_wallpaper_items(items)
+            for item in items:
+                self.visibility_index.remove(item)
+            self.wallpapers_flowbox_thumbnails.invalidate_layout()
+            self.wallpapers_flowbox_favorites_thumbnails.invalidate_layout()
+        if added:
+            self.wallpapers_list.extend(added)
+            self.fill_wallpapers_flowbox(added)
 
     def do_activate(self):
         self.add_window(self.window)
@@ -489,18 +659,10 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
 
         about_action = Gio.SimpleAction.new("about", None)
         about_action.connect("activate", self.on_about_activate)
-        self.builder.get_object("aboutdialog").connect(
-            "delete-event", lambda *_:
-                self.builder.get_object("aboutdialog").hide() or True
-        )
         self.add_action(about_action)
 
         settings_action = Gio.SimpleAction.new("settings", None)
         settings_action.connect("activate", self.on_settings_activate)
-        self.builder.get_object("settingsWindow").connect(
-            "delete-event", lambda *_:
-                self.builder.get_object("settingsWindow").hide() or True
-        )
         self.add_action(settings_action)
 
         quit_action = Gio.SimpleAction.new("quit", None)
@@ -511,9 +673,43 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
         self.fill_monitors_flowbox()
         self.fill_wallpapers_folders_popover_listbox()
 
+        # scan once the window is on screen, so that it shows up right away
+        self.window.connect('map-event', self.on_window_map_event)
         self.window.show_all()
 
-        self.refresh_wallpapers_flowbox()
+    def on_window_map_event(self, *args):
+        self.window.disconnect_by_func(self.on_window_map_event)
+        self.startup_timer.mark('window shown')
+        GLib.idle_add(self.refresh_wallpapers_flowbox)
+        return False
+
+    def on_window_focus_in_event(self, *args):
+        # the daemon or the command line may have set wallpapers meanwhile
+        # favorites toggled here but not saved yet must win the merge
+        self.favorites.sync_to_config()
+        self.config_store.merge_saved_changes()
+        old_favorites = set(self.favorites)
+        self.favorites.reload()
+        changed_items = []
+        for wp_path in old_favorites.symmetric_difference(self.favorites):
+            item = self.visibility_index.get_item(wp_path)
+            if not item:
+                continue
+            for wb in self.get_wallpaper_widgets(item):
+                wb.set_fav(wp_path in self.favorites)
+            changed_items.append(item)
+        if changed_items:
+            self.update_wallpapers_visibility(changed_items)
+        wallpapers_changed = False
+        for m in self.monitors:
+            wp_path = self.configuration['monitors'].get(m.name)
+            if wp_path != m.wallpaper:
+                m.wallpaper = wp_path
+                self.load_monitor_preview(m)
+                wallpapers_changed = True
+        if wallpapers_changed:
+            self.queue_prerender()
+        return False
 
     def do_command_line(self, args):
         """
@@ -526,17 +722,19 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
         parser = argparse.ArgumentParser(prog='gui')
         # add a -c/--color option
         parser.add_argument('-q', '--quit-after-init', dest='quit_after_init', action='store_true', help='initialize application (e.g. for macros initialization on system startup) and quit')
+        Profiling.add_argparse_arguments(parser)
         # parse the command line stored in args, but skip the first element (the filename)
         self.args = parser.parse_args(args.get_arguments()[1:])
+        Profiling.enable_from_args(self.args)
         # call the main program do_activate() to start up the app
         self.do_activate()
         return 0
 
     def on_about_activate(self, *args):
-        self.builder.get_object("aboutdialog").show()
+        self.get_lazy_object("aboutdialog").show()
 
     def on_settings_activate(self, *args):
-        self.builder.get_object("settingsWindow").show()
+        self.get_lazy_object("settingsWindow").show()
 
     def on_quit_activate(self, *args):
         self.do_before_quit()
@@ -574,64 +772,68 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
             )
 
     def on_aboutdialog_close(self, *args):
-        self.builder.get_object("aboutdialog").hide()
+        self.get_lazy_object("aboutdialog").hide()
 
     def on_wallpapersFlowbox_child_activated(self, flowbox, selected_item):
         self.set_monitor_wallpaper_preview(
-            selected_item.get_child().wallpaper_path
+            selected_item.wallpaper_path,
+            selected_item.get_thumbnail_pixbuf()
         )
+        self.queue_prerender()
+
+    def cancel_prerender(self):
+        if self.prerender_task:
+            self.prerender_task.cancel()
+            self.prerender_task = None
+        # stops a merge already running at the next tile
+        self.prerender_cancelled.set()
+
+    def queue_prerender(self):
+        # merges the current selection in the background, so that Apply
+        # is just a cache hit (or waits for this merge to end)
+        self.cancel_prerender()
+        if not self.configuration['merge_prerender'] or len(self.monitors) < 2:
+            return
+        for m in self.monitors:
+            if not m.wallpaper or not os.path.isfile(m.wallpaper):
+                return
+        self.prerender_cancelled = threading.Event()
+        self.prerender_task = self.task_scheduler.submit(
+            WallpaperMerger.merge_wallpapers_cached,
+            # copies, the selection may change while merging
+            [copy.copy(m) for m in self.monitors],
+            self.merge_cache,
+            self.configuration,
+            self.tile_cache,
+            self.prerender_cancelled.is_set,
+            callback=self.on_prerender_done,
+            error_callback=self.on_prerender_error,
+            priority=TaskScheduler.PRIORITY_LOW
+        )
+
+    def on_prerender_done(self, *args):
+        self.prerender_task = None
+
+    def on_prerender_error(self, exc):
+        self.prerender_task = None
+        if not isinstance(exc, WallpaperMerger.MergeCancelled):
+            print('Error: could not pre-render wallpapers: {0}'.format(exc))
 
     def apply_button_async_handler(self, monitors):
-        desktop_environment = os.environ.get('XDG_CURRENT_DESKTOP')
-        if desktop_environment == 'MATE':
-            wp_setter_func = WallpaperMerger.set_wallpaper_mate
-        else:
-            wp_setter_func = WallpaperMerger.set_wallpaper_gnome
-        if len(monitors) == 1:
-            wp_setter_func(monitors[0].wallpaper, 'zoom')
-            return
-        #if len(self.monitors) != 2:
-        #    print('Configurations different from 2 monitors are not supported for now :(')
-        #    exit(1)
-        if not os.path.isdir(HYDRAPAPER_CACHE_PATH):
-            os.mkdir(HYDRAPAPER_CACHE_PATH)
-        new_wp_filename = '_'.join(([m.__repr__() for m in monitors]))
-        saved_wp_path = '{0}/{1}.png'.format(HYDRAPAPER_CACHE_PATH, hashlib.sha256(
-            'HydraPaper{0}'.format(new_wp_filename).encode()
-        ).hexdigest())
-        if not os.path.isfile(saved_wp_path):
-            WallpaperMerger.multi_setup_pillow(
-                monitors,
-                saved_wp_path
-            )
-        else:
-            print(
-                'Hit cache for wallpaper {0}. Skipping merge operation.'.format(
-                    saved_wp_path
-                )
-            )
-        wp_setter_func(saved_wp_path)
+        WallpaperMerger.apply_wallpapers(
+            monitors, self.merge_cache, self.configuration, self.tile_cache
+        )
 
     def set_favorite_state(self, wp_path, wp_widget, isfavorite):
-        if isfavorite:
-            widget_c = self.make_wallpapers_flowbox_item(wp_path)
-            widget_c.set_fav(True)
-            wp_widget.set_fav(True)
-            self.wallpapers_flowbox_favorites.insert(widget_c, -1)
-            widget_c.show_all()
-            self.wallpapers_flowbox_favorites.show_all()
-            widget_c.set_wallpaper_thumb()
-        else:
-            for wb in self.wallpapers_flowbox_favorites.get_children():
-                if wb.wallpaper_path == wp_path:
-                    self.wallpapers_flowbox_favorites.remove(wb)
-                    wb.destroy()
-                    break
-            for wb in self.wallpapers_flowbox.get_children():
-                if wb.wallpaper_path == wp_path:
-                    wb.set_fav(False)
-                    break
-        self.show_hide_wallpapers()
+        self.favorites.set_favorite(wp_path, isfavorite)
+        self.save_config_file()
+        item = self.visibility_index.get_item(wp_path)
+        if not item:
+            return
+        # widgets created by the refilter already get the right heart icon
+        for wb in self.get_wallpaper_widgets(item):
+            wb.set_fav(isfavorite)
+        self.update_wallpapers_visibility([item])
 
     def on_wallpapersFlowboxItemoptionsPopover_notify_visible(self, *args):
         if self.favorites_button_clicked:
@@ -639,11 +841,6 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
             if not self.child_at_pos:
                 return
             wp_path = self.child_at_pos.get_child().wallpaper_path
-            if 'add' in button.get_label().lower():
-                self.configuration['favorites'].append(wp_path)
-            else:
-                self.configuration['favorites'].pop(self.configuration['favorites'].index(wp_path))
-            self.save_config_file()
             self.wallpapers_flowbox_itemoptions_popover.set_relative_to(self.wallpapers_flowbox)
             self.set_favorite_state(wp_path, self.child_at_pos, 'add' in button.get_label().lower())
             self.favorites_button_clicked = False
@@ -667,10 +864,21 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
         # activate spinner
         self.apply_spinner.show()
         self.apply_spinner.start()
-        # run thread
-        thread = ThreadingHelper.do_async(self.apply_button_async_handler, (self.monitors[:],))
-        # wait for thread to finish
-        ThreadingHelper.wait_for_thread(thread)
+        # run the merge in the background, interaction is restored
+        # by the completion callback
+        self.task_scheduler.submit(
+            self.apply_button_async_handler,
+            self.monitors[:],
+            callback=self.on_apply_done,
+            error_callback=self.on_apply_error,
+            priority=TaskScheduler.PRIORITY_HIGH
+        )
+
+    def on_apply_error(self, exc):
+        print('Error: could not apply wallpapers: {0}'.format(exc))
+        self.on_apply_done()
+
+    def on_apply_done(self, *args):
         # restore interaction and deactivate spinner
         self.apply_button.set_sensitive(True)
         self.monitors_flowbox.set_sensitive(True)
@@ -706,21 +914,28 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
             self.configuration['selection_mode'] = 'single'
         self.wallpapers_flowbox.set_activate_on_single_click(not doubleclick_activate)
         self.wallpapers_flowbox_favorites.set_activate_on_single_click(not doubleclick_activate)
-        self.save_config_file(self.configuration)
+        self.save_config_file()
 
     def on_keepFavoritesInMainviewToggle_state_set(self, switch, favs_in_mainview):
         if self.configuration['favorites_in_mainview'] != favs_in_mainview:
             self.configuration['favorites_in_mainview'] = favs_in_mainview
-            self.save_config_file(self.configuration)
-            self.show_hide_wallpapers()
+            self.save_config_file()
+            # only the favorites in the main view are affected
+            self.update_wallpapers_visibility(
+                self.visibility_index.get_favorites_items()
+            )
 
     def on_resetFavoritesButton_clicked(self, button):
-        self.configuration['favorites'] = []
+        self.favorites.clear()
         self.save_config_file()
         self.refresh_wallpapers_flowbox()
 
     def unminimize_all_other_windows(self):
         from time import time as timestamp
+        if not self.windows_to_restore:
+            # nothing was minimized, no need to load Wnck
+            return
+        from gi.repository import Wnck
         screen = Wnck.Screen.get_default()
         screen.force_update()  # recommended per Wnck documentation
         for window in self.windows_to_restore:
@@ -734,6 +949,7 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
     def on_lowerAllOtherWindowsToggle_toggled(self, toggle):
         if toggle.get_active():
             self.builder.get_object('lowerAllOtherWindowsToggle').get_child().set_from_icon_name('go-top-symbolic', Gtk.IconSize.BUTTON)
+            from gi.repository import Wnck
             screen = Wnck.Screen.get_default()
             screen.force_update()  # recommended per Wnck documentation
             self.windows_to_restore = []
@@ -746,12 +962,12 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
             self.unminimize_all_other_windows()
 
     def on_addWallpapersPath_clicked(self, button):
-        self.builder.get_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
-        self.builder.get_object('addFolderFileChooserDialog').run()
+        self.get_lazy_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
+        self.get_lazy_object('addFolderFileChooserDialog').run()
 
     def on_addFolderFileChooserDialogCancelButton_clicked(self, button):
-        self.builder.get_object('addFolderFileChooserDialog').hide()
-        self.builder.get_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
+        self.get_lazy_object('addFolderFileChooserDialog').hide()
+        self.get_lazy_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
 
     def wallpaper_path_exists(self, folder):
         for wp in self.configuration['wallpapers_paths']:
@@ -760,17 +976,17 @@ If you\'re still experiencing problems, considering filling an issue <a href="ht
         return False
 
     def on_addFolderFileChooserDialogOpenButton_clicked(self, button):
-        new_path = self.builder.get_object('addFolderFileChooserDialog').get_filename()
+        new_path = self.get_lazy_object('addFolderFileChooserDialog').get_filename()
         if os.path.isdir(new_path):
             if not self.wallpaper_path_exists(new_path):
-                self.builder.get_object('addFolderFileChooserDialog').hide()
-                self.builder.get_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
+                self.get_lazy_object('addFolderFileChooserDialog').hide()
+                self.get_lazy_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
                 self.add_new_wallpapers_path(new_path)
             else:
-                self.builder.get_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(True)
+                self.get_lazy_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(True)
 
     def on_pathAlreadyAddedInfobarLikeRevealerCloseButton_clicked(self, button):
-        self.builder.get_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
+        self.get_lazy_object('pathAlreadyAddedInfobarLikeRevealer').set_reveal_child(False)
 
     def on_wallpapersFoldersPopoverListbox_row_selected(self, listbox, row):
         self.builder.get_object('removeWallpapersPath').set_sensitive(not not row and self.builder.get_object('addWallpapersPath').get_sensitive())
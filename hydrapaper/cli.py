@@ -0,0 +1,101 @@
+import os
+import argparse
+
+from gi.repository import GLib, Gio
+
+from . import config_store as ConfigStore
+from . import monitor_parser as MonitorParser
+from . import merge_cache as MergeCache
+from . import wallpaper_merger as WallpaperMerger
+from . import service as Service
+from . import profiling as Profiling
+
+# Headless commands, dispatched by bin/hydrapaper before anything Gtk
+# gets imported. Nothing here may import Gtk, Gdk or Wnck.
+
+
+def apply_with_service():
+    # returns None if the service isn't running, it's not started for this
+    try:
+        bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        result = bus.call_sync(
+            Service.BUS_NAME,
+            Service.OBJECT_PATH,
+            Service.INTERFACE_NAME,
+            'Apply',
+            None,
+            GLib.VariantType.new('(s)'),
+            Gio.DBusCallFlags.NO_AUTO_START,
+            -1,
+            None
+        )
+    except GLib.Error as e:
+        if Gio.DBusError.is_remote_error(e) and (
+                Gio.DBusError.get_remote_error(e) == Service.ERROR_NAME
+        ):
+            Gio.DBusError.strip_remote_error(e)
+            print('Error: {0}'.format(e.message))
+            return False
+        return None
+    return result.unpack()[0]
+
+
+def apply(args):
+    if not args.no_service:
+        # the service has everything loaded already
+        applied = apply_with_service()
+        if applied is not None:
+            return 0 if applied else 1
+    config_store = ConfigStore.ConfigStore()
+    configuration = config_store.load()
+    monitors = MonitorParser.build_monitors_from_config(
+        configuration['monitors_layout']
+    )
+    if not monitors:
+        print('Error: no monitor layout saved, start HydraPaper once to save it')
+        return 1
+    for m in monitors:
+        m.wallpaper = configuration['monitors'].get(m.name)
+        if not m.wallpaper or not os.path.isfile(m.wallpaper):
+            print('Error: no valid wallpaper set for {0}'.format(m.name))
+            return 1
+    merge_cache = MergeCache.MergeCache(
+        ConfigStore.CACHE_PATH,
+        configuration['merge_cache_max_size_mb'],
+        configuration['merge_cache_max_age_days'],
+        WallpaperMerger.get_current_wallpapers
+    )
+    WallpaperMerger.apply_wallpapers(monitors, merge_cache, configuration)
+    # gsettings writes are asynchronous, don't exit before they're done
+    Gio.Settings.sync()
+    # in case defaults were added
+    config_store.flush()
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='hydrapaper')
+    subparsers = parser.add_subparsers(dest='command')
+    apply_parser = subparsers.add_parser(
+        'apply',
+        help='apply the wallpapers saved in the configuration, without starting the user interface'
+    )
+    apply_parser.add_argument(
+        '--no-service', dest='no_service', action='store_true',
+        help='apply in this process even if the HydraPaper service is running'
+    )
+    Profiling.add_argparse_arguments(apply_parser)
+    daemon_parser = subparsers.add_parser(
+        'daemon',
+        help='run the HydraPaper service, exposing its operations on the session bus'
+    )
+    Profiling.add_argparse_arguments(daemon_parser)
+    args = parser.parse_args(argv)
+    if args.command:
+        Profiling.enable_from_args(args)
+    if args.command == 'apply':
+        return apply(args)
+    if args.command == 'daemon':
+        return Service.main()
+    parser.print_help()
+    return 1
@@ -0,0 +1,271 @@
+import os
+import json
+
+from gi.repository import GLib
+
+from . import thumbnail_cache as ThumbnailCache
+from . import merge_cache as MergeCache
+from . import wallpaper_merger as WallpaperMerger
+
+HOME = os.environ.get('HOME')
+CONFIG_FILE_PATH = '{0}/.config/hydrapaper.json'.format(HOME)
+CACHE_PATH = '{0}/.cache/hydrapaper'.format(HOME)
+
+# check if inside flatpak sandbox. if so change some variables
+if 'XDG_RUNTIME_DIR' in os.environ.keys():
+    if os.path.isfile('{0}/flatpak-info'.format(os.environ['XDG_RUNTIME_DIR'])):
+        CONFIG_FILE_PATH = '{0}/hydrapaper.json'.format(os.environ.get('XDG_CONFIG_HOME'))
+        CACHE_PATH = '{0}/hydrapaper'.format(os.environ.get('XDG_CACHE_HOME'))
+
+SAVE_DELAY_MS = 1000
+MISSING = object()
+
+
+def get_default_wallpapers_paths():
+    return [
+        {
+            'path': '{0}/Pictures'.format(HOME),
+            'active': True
+        },
+        {
+            'path': '/usr/share/backgrounds/gnome/',
+            'active': True
+        }
+    ]
+
+
+def merge_changes(base, ours, theirs):
+    '''
+    Three-way merge of configurations, in place in ours: the keys theirs
+    changed from base take its value, unless ours changed them too, in
+    which case ours wins. Nested dicts (e.g. 'monitors') are merged key
+    by key.
+    '''
+    for key in set(base.keys()) | set(ours.keys()) | set(theirs.keys()):
+        base_value = base.get(key, MISSING)
+        our_value = ours.get(key, MISSING)
+        their_value = theirs.get(key, MISSING)
+        if their_value == base_value or their_value == our_value:
+            continue
+        if our_value == base_value:
+            if their_value is MISSING:
+                ours.pop(key)
+            else:
+                ours[key] = their_value
+        elif all(isinstance(v, dict) for v in (base_value, our_value, their_value)):
+            merge_changes(base_value, our_value, their_value)
+
+
+class ConfigStore:
+    '''
+    Loads hydrapaper.json, filling in the defaults, and writes it back.
+    save() only schedules a write: changes made in a short time span
+    (e.g. many favorites toggled in a row) end up in a single write,
+    done atomically through a temporary file and a rename so that a
+    crash can't leave a truncated file behind. Writes of a configuration
+    identical to the one on disk are skipped. Changes written by another
+    process in the meantime (e.g. the daemon) are merged in before
+    writing, see merge_changes.
+    Doesn't depend on Gtk, without a running main loop call flush().
+    '''
+
+    def __init__(self, config_file_path=CONFIG_FILE_PATH, save_delay_ms=SAVE_DELAY_MS):
+        self.config_file_path = config_file_path
+        self.save_delay_ms = save_delay_ms
+        self.configuration = None
+        # serialized configuration as last read or written
+        self.saved_data = None
+        self.save_source = None
+        # called before serializing, to write back state kept elsewhere
+        self.flush_callbacks = []
+
+    def add_flush_callback(self, callback):
+        self.flush_callbacks.append(callback)
+
+    def load(self):
+        if not os.path.isfile(self.config_file_path):
+            self.configuration = {
+                'wallpapers_paths': get_default_wallpapers_paths(),
+                'selection_mode': 'single',
+                'monitors': {},
+                'monitors_layout': [],
+                'favorites': [],
+                'favorites_in_mainview': False,
+                'windowsize': {
+                    'width': 600,
+                    'height': 400
+                },
+                'thumbnail_cache_max_size_mb': ThumbnailCache.DEFAULT_MAX_SIZE_MB,
+                'merge_cache_max_size_mb': MergeCache.DEFAULT_MAX_SIZE_MB,
+                'merge_cache_max_age_days': MergeCache.DEFAULT_MAX_AGE_DAYS,
+                'merge_quality': WallpaperMerger.MERGE_QUALITY_EXACT,
+                'merge_output_format': WallpaperMerger.OUTPUT_FORMAT_PNG,
+                'merge_png_compress_level': WallpaperMerger.DEFAULT_PNG_COMPRESS_LEVEL,
+                'merge_low_memory': False,
+                'merge_prerender': True,
+                'merge_backend': WallpaperMerger.MERGE_BACKEND_PILLOW,
+                'merge_match_colors': False,
+                'recursive_scan': False,
+            }
+            self.save()
+            return self.configuration
+        do_save = False
+        with open(self.config_file_path, 'r') as fd:
+            data = fd.read()
+        self.saved_data = data
+        config = json.loads(data)
+        if not 'wallpapers_paths' in config.keys():
+            config['wallpapers_paths'] = get_default_wallpapers_paths()
+            do_save = True
+        for index, path in enumerate(config['wallpapers_paths']):
+            if type(path) == str:
+                config['wallpapers_paths'][index] = {
+                    'path': path,
+                    'active': True
+                }
+                do_save = True
+        if not 'selection_mode' in config.keys():
+            config['selection_mode'] = 'single'
+            do_save = True
+        if not 'monitors' in config.keys():
+            config['monitors'] = {}
+            do_save = True
+        if not 'monitors_layout' in config.keys():
+            config['monitors_layout'] = []
+            do_save = True
+        if not 'favorites' in config.keys():
+            config['favorites'] = []
+            do_save = True
+        if not 'favorites_in_mainview' in config.keys():
+            config['favorites_in_mainview'] = False
+            do_save = True
+        if not 'windowsize' in config.keys():
+            config['windowsize'] = {
+                'width': 600,
+                'height': 400
+            }
+            do_save = True
+        if not 'thumbnail_cache_max_size_mb' in config.keys():
+            config['thumbnail_cache_max_size_mb'] = ThumbnailCache.DEFAULT_MAX_SIZE_MB
+            do_save = True
+        if not 'merge_cache_max_size_mb' in config.keys():
+            config['merge_cache_max_size_mb'] = MergeCache.DEFAULT_MAX_SIZE_MB
+            do_save = True
+        if not 'merge_cache_max_age_days' in config.keys():
+            config['merge_cache_max_age_days'] = MergeCache.DEFAULT_MAX_AGE_DAYS
+            do_save = True
+        if not config.get('merge_quality') in WallpaperMerger.MERGE_QUALITIES:
+            config['merge_quality'] = WallpaperMerger.MERGE_QUALITY_EXACT
+            do_save = True
+        if not config.get('merge_output_format') in WallpaperMerger.OUTPUT_FORMATS:
+            config['merge_output_format'] = WallpaperMerger.OUTPUT_FORMAT_PNG
+            do_save = True
+        png_compress_level = config.get('merge_png_compress_level')
+        if not (
+                isinstance(png_compress_level, int) and
+                png_compress_level in WallpaperMerger.PNG_COMPRESS_LEVELS
+        ):
+            config['merge_png_compress_level'] = WallpaperMerger.DEFAULT_PNG_COMPRESS_LEVEL
+            do_save = True
+        if not 'merge_low_memory' in config.keys():
+            config['merge_low_memory'] = False
+            do_save = True
+        if not 'merge_prerender' in config.keys():
+            config['merge_prerender'] = True
+            do_save = True
+        if not config.get('merge_backend') in WallpaperMerger.MERGE_BACKENDS:
+            config['merge_backend'] = WallpaperMerger.MERGE_BACKEND_PILLOW
+            do_save = True
+        if not 'merge_match_colors' in config.keys():
+            config['merge_match_colors'] = False
+            do_save = True
+        if not 'recursive_scan' in config.keys():
+            config['recursive_scan'] = False
+            do_save = True
+        self.configuration = config
+        if do_save:
+            self.save()
+        return config
+
+    def reload(self):
+        '''
+        Loads the file again if another process changed it since it was
+        last read or written. Changes waiting to be written win.
+        '''
+        if self.configuration is not None and self.save_source:
+            return self.configuration
+        try:
+            with open(self.config_file_path, 'r') as fd:
+                data = fd.read()
+        except OSError:
+            data = None
+        if self.configuration is None or data != self.saved_data:
+            return self.load()
+        return self.configuration
+
+    def save(self):
+        '''
+        Schedules a write of the configuration, restarting the delay if
+        one is already scheduled.
+        '''
+        if self.save_source:
+            GLib.source_remove(self.save_source)
+        self.save_source = GLib.timeout_add(self.save_delay_ms, self.on_save_timeout)
+
+    def on_save_timeout(self):
+        self.save_source = None
+        self.flush()
+        return False  # remove the timeout source
+
+    def merge_saved_changes(self):
+        '''
+        Merges in the changes another process wrote to the file since it
+        was last read or written, keeping the ones waiting to be written.
+        '''
+        if self.saved_data is None:
+            return
+        try:
+            with open(self.config_file_path, 'r') as fd:
+                data = fd.read()
+        except OSError:
+            return
+        if data == self.saved_data:
+            return
+        try:
+            saved = json.loads(data)
+            base = json.loads(self.saved_data)
+        except ValueError:
+            return  # ours replaces a corrupted file
+        merge_changes(base, self.configuration, saved)
+        self.saved_data = data
+
+    def flush(self):
+        '''
+        Writes the configuration right away if it changed, cancelling
+        any scheduled write. To be called at quit.
+        '''
+        if self.save_source:
+            GLib.source_remove(self.save_source)
+            self.save_source = None
+        if self.configuration is None:
+            return
+        for callback in self.flush_callbacks:
+            callback()
+        self.merge_saved_changes()
+        data = json.dumps(self.configuration)
+        if data == self.saved_data:
+            return
+        tmp_path = '{0}.tmp'.format(self.config_file_path)
+        try:
+            os.makedirs(os.path.dirname(self.config_file_path), exist_ok=True)
+            with open(tmp_path, 'w') as fd:
+                fd.write(data)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmp_path, self.config_file_path)
+        except OSError as e:
+            print('Error: cannot save configuration to {0}: {1}'.format(
+                self.config_file_path, e
+            ))
+            return
+        self.saved_data = data
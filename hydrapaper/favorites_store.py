@@ -0,0 +1,42 @@
+class FavoritesStore:
+    '''
+    The favorite wallpapers, kept in an insertion ordered dict so that
+    membership, adding and removing are constant time. The configuration
+    keeps storing them as a list, for compatibility: the list is only
+    rebuilt when the configuration gets written, through sync_to_config.
+    '''
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.favorites = dict.fromkeys(configuration['favorites'])
+
+    def __contains__(self, wp_path):
+        return wp_path in self.favorites
+
+    def __iter__(self):
+        return iter(self.favorites)
+
+    def __len__(self):
+        return len(self.favorites)
+
+    def add(self, wp_path):
+        self.favorites[wp_path] = None
+
+    def remove(self, wp_path):
+        self.favorites.pop(wp_path, None)
+
+    def set_favorite(self, wp_path, isfavorite):
+        if isfavorite:
+            self.add(wp_path)
+        else:
+            self.remove(wp_path)
+
+    def clear(self):
+        self.favorites = {}
+
+    def reload(self):
+        # after the configuration got changes from another process
+        self.favorites = dict.fromkeys(self.configuration['favorites'])
+
+    def sync_to_config(self):
+        self.configuration['favorites'] = list(self.favorites)
@@ -0,0 +1,122 @@
+import os
+import time
+
+from gi.repository import Gio, GLib
+
+from . import wallpaper_scanner as WallpaperScanner
+
+DEBOUNCE_MS = 500
+# during a long burst (e.g. copying thousands of files) still deliver
+# changes at least this often
+MAX_DELAY_S = 2
+
+
+class FolderWatcher:
+    '''
+    Watches the wallpaper folders with Gio.FileMonitor and reports the
+    images added and removed in them. Renames are reported as a removal
+    and an addition. New files are only reported once fully written
+    (CHANGES_DONE_HINT), not when created, so that a long copy isn't
+    picked up half way; a file rewritten in place is reported as added
+    again. Events are coalesced and debounced, so a burst of
+    events results in a single on_changes(added, removed) call, with
+    both being lists of paths in the same format as wallpaper_scanner.
+    Subfolders are not watched.
+    '''
+
+    def __init__(self, on_changes, debounce_ms=DEBOUNCE_MS):
+        self.on_changes = on_changes
+        self.debounce_ms = debounce_ms
+        self.monitors = {}  # folder -> Gio.FileMonitor
+        self.pending_added = set()
+        self.pending_removed = set()
+        self.debounce_source = None
+        self.first_pending_time = None
+
+    def watch(self, folders):
+        '''
+        Sets the folders to watch, stopping the monitors of folders not
+        in the list anymore.
+        '''
+        for folder in list(self.monitors.keys()):
+            if folder not in folders:
+                self.monitors.pop(folder).cancel()
+        for folder in folders:
+            if folder in self.monitors or not os.path.isdir(folder):
+                continue
+            try:
+                monitor = Gio.File.new_for_path(folder).monitor_directory(
+                    Gio.FileMonitorFlags.WATCH_MOVES, None
+                )
+            except GLib.Error as e:
+                print('Error: cannot watch folder {0}: {1}'.format(folder, e))
+                continue
+            monitor.connect('changed', self.on_monitor_changed, folder)
+            self.monitors[folder] = monitor
+
+    def stop(self):
+        self.watch([])
+        if self.debounce_source:
+            GLib.source_remove(self.debounce_source)
+            self.debounce_source = None
+
+    def get_wallpaper_path(self, folder, gfile):
+        if not gfile:
+            return None
+        name = gfile.get_basename()
+        if not WallpaperScanner.is_image_filename(name):
+            return None
+        # same format as the paths saved in the favorites
+        return '{0}/{1}'.format(folder, name)
+
+    def on_monitor_changed(self, monitor, gfile, other_gfile, event_type, folder):
+        path = self.get_wallpaper_path(folder, gfile)
+        if event_type in (
+                Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                Gio.FileMonitorEvent.MOVED_IN
+        ):
+            self.queue(added=[path])
+        elif event_type in (
+                Gio.FileMonitorEvent.DELETED,
+                Gio.FileMonitorEvent.MOVED_OUT
+        ):
+            self.queue(removed=[path])
+        elif event_type == Gio.FileMonitorEvent.RENAMED:
+            self.queue(
+                added=[self.get_wallpaper_path(folder, other_gfile)],
+                removed=[path]
+            )
+
+    def queue(self, added=(), removed=()):
+        '''
+        Adds changes to the pending ones and (re)starts the debounce timer.
+        Can also be used to put back changes that couldn't be applied yet.
+        '''
+        for path in removed:
+            if path:
+                self.pending_added.discard(path)
+                self.pending_removed.add(path)
+        for path in added:
+            if path:
+                self.pending_removed.discard(path)
+                self.pending_added.add(path)
+        if not self.pending_added and not self.pending_removed:
+            return
+        now = time.monotonic()
+        if self.first_pending_time is None:
+            self.first_pending_time = now
+        if self.debounce_source:
+            if now - self.first_pending_time > MAX_DELAY_S:
+                return  # let the current timer fire
+            GLib.source_remove(self.debounce_source)
+        self.debounce_source = GLib.timeout_add(self.debounce_ms, self.flush)
+
+    def flush(self):
+        self.debounce_source = None
+        self.first_pending_time = None
+        added = sorted(self.pending_added)
+        removed = sorted(self.pending_removed)
+        self.pending_added = set()
+        self.pending_removed = set()
+        self.on_changes(added, removed)
+        return False  # remove the timeout source
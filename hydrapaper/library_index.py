@@ -0,0 +1,266 @@
+import os
+import sqlite3
+import threading
+
+from gi.repository import GdkPixbuf
+
+from . import wallpaper_scanner as WallpaperScanner
+
+INDEX_FILENAME = 'library.sqlite'
+SCHEMA_VERSION = 1
+
+
+class LibraryIndex:
+    '''
+    Persistent index of the wallpapers in the configured folders, stored
+    as SQLite in the cache directory. Every directory is recorded with
+    its mtime: a rescan only lists the directories whose mtime changed
+    (a file was added, removed or renamed in them) and serves everything
+    else from the index, so an unchanged library costs a stat per
+    directory.
+    For each wallpaper it records size, mtime, dimensions and thumbnail
+    key. Size and mtime are those seen when the directory was last
+    listed; in-place edits don't change the directory mtime, the caches
+    relying on them stat the file themselves.
+    '''
+
+    def __init__(self, cache_path, thumbnail_cache=None):
+        os.makedirs(cache_path, exist_ok=True)
+        self.thumbnail_cache = thumbnail_cache
+        self.lock = threading.Lock()
+        self.closed = False
+        self.db = sqlite3.connect(
+            '{0}/{1}'.format(cache_path, INDEX_FILENAME),
+            check_same_thread=False
+        )
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.create_schema()
+
+    def create_schema(self):
+        with self.lock, self.db:
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.db.execute('DROP TABLE IF EXISTS directories')
+                self.db.execute('DROP TABLE IF EXISTS wallpapers')
+            # mtime_ns is NULL for directories known to exist but never listed
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT,
+                    mtime_ns INTEGER
+                )
+            ''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS wallpapers (
+                    path TEXT PRIMARY KEY,
+                    directory TEXT NOT NULL,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    width INTEGER,
+                    height INTEGER,
+                    thumbnail_key TEXT
+                )
+            ''')
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent)'
+            )
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS wallpapers_directory ON wallpapers (directory)'
+            )
+            self.db.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+
+    def scan(self, folders, recursive=False, batch_callback=None,
+             batch_size=WallpaperScanner.DEFAULT_BATCH_SIZE):
+        '''
+        Same contract as wallpaper_scanner.scan_folders, updating the
+        index along the way.
+        '''
+        seen = set()
+        batch = []
+        with self.lock, self.db:
+            self.prune_roots(folders)
+            for folder in folders:
+                pending_dirs = [(folder, None)]
+                while pending_dirs:
+                    current_dir, parent = pending_dirs.pop()
+                    wallpapers, subdirs = self.scan_directory(current_dir, parent)
+                    if recursive:
+                        pending_dirs.extend((d, current_dir) for d in subdirs)
+                    for wp_path in wallpapers:
+                        if wp_path in seen:
+                            continue
+                        seen.add(wp_path)
+                        batch.append(wp_path)
+                        if batch_callback and len(batch) >= batch_size:
+                            batch_callback(batch)
+                            batch = []
+        return batch
+
+    def scan_directory(self, directory, parent):
+        # must be called with self.lock held, inside a transaction
+        # returns the wallpapers and subdirectories of directory
+        try:
+            dir_mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            self.forget_directory(directory)
+            return [], []
+        row = self.db.execute(
+            'SELECT mtime_ns FROM directories WHERE path = ?', (directory,)
+        ).fetchone()
+        if row and row[0] == dir_mtime_ns:
+            wallpapers = [r[0] for r in self.db.execute(
+                'SELECT path FROM wallpapers WHERE directory = ?', (directory,)
+            )]
+            subdirs = [r[0] for r in self.db.execute(
+                'SELECT path FROM directories WHERE parent = ?', (directory,)
+            )]
+            return wallpapers, subdirs
+        return self.list_directory(directory, parent, dir_mtime_ns)
+
+    def list_directory(self, directory, parent, dir_mtime_ns):
+        # must be called with self.lock held, inside a transaction
+        wallpapers = {}
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            if WallpaperScanner.is_image_filename(entry.name):
+                                st = entry.stat()
+                                # same format as the paths saved in the favorites
+                                wallpapers['{0}/{1}'.format(directory, entry.name)] = st
+                        elif entry.is_dir(follow_symlinks=False):
+                            subdirs.append('{0}/{1}'.format(directory, entry.name))
+                    except OSError:
+                        continue
+        except OSError:
+            self.forget_directory(directory)
+            return [], []
+        known = {
+            r[0]: (r[1], r[2]) for r in self.db.execute(
+                'SELECT path, size, mtime_ns FROM wallpapers WHERE directory = ?',
+                (directory,)
+            )
+        }
+        for wp_path in known.keys() - wallpapers.keys():
+            self.db.execute('DELETE FROM wallpapers WHERE path = ?', (wp_path,))
+        for wp_path, st in wallpapers.items():
+            if known.get(wp_path) != (st.st_size, st.st_mtime_ns):
+                self.insert_wallpaper(wp_path, directory, st)
+        known_subdirs = {r[0] for r in self.db.execute(
+            'SELECT path FROM directories WHERE parent = ?', (directory,)
+        )}
+        for subdir in known_subdirs - set(subdirs):
+            self.forget_directory(subdir)
+        for subdir in set(subdirs) - known_subdirs:
+            self.db.execute(
+                'INSERT OR IGNORE INTO directories (path, parent, mtime_ns) VALUES (?, ?, NULL)',
+                (subdir, directory)
+            )
+        self.db.execute(
+            'INSERT OR REPLACE INTO directories (path, parent, mtime_ns) VALUES (?, ?, ?)',
+            (directory, parent, dir_mtime_ns)
+        )
+        return list(wallpapers.keys()), subdirs
+
+    def insert_wallpaper(self, wp_path, directory, st):
+        # must be called with self.lock held, inside a transaction
+        # dimensions are filled in later by fill_missing_dimensions,
+        # reading image headers would slow down the scan
+        if self.thumbnail_cache:
+            thumbnail_key = self.thumbnail_cache.get_key(wp_path)
+        else:
+            thumbnail_key = None
+        self.db.execute(
+            '''INSERT OR REPLACE INTO wallpapers
+            (path, directory, size, mtime_ns, width, height, thumbnail_key)
+            VALUES (?, ?, ?, ?, NULL, NULL, ?)''',
+            (wp_path, directory, st.st_size, st.st_mtime_ns, thumbnail_key)
+        )
+
+    def forget_directory(self, directory):
+        # must be called with self.lock held, inside a transaction
+        # not using LIKE, paths may contain % and _
+        prefix = '{0}/'.format(directory.rstrip('/'))
+        self.db.execute(
+            'DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?',
+            (directory, len(prefix), prefix)
+        )
+        self.db.execute(
+            'DELETE FROM wallpapers WHERE directory = ? OR substr(directory, 1, ?) = ?',
+            (directory, len(prefix), prefix)
+        )
+
+    def prune_roots(self, folders):
+        # must be called with self.lock held, inside a transaction
+        # drops the folders that are no longer configured
+        for r in self.db.execute(
+                'SELECT path FROM directories WHERE parent IS NULL'
+        ).fetchall():
+            if r[0] not in folders:
+                self.forget_directory(r[0])
+
+    def add_wallpaper(self, wp_path):
+        directory = os.path.dirname(wp_path)
+        try:
+            st = os.stat(wp_path)
+        except OSError:
+            return
+        with self.lock, self.db:
+            self.insert_wallpaper(wp_path, directory, st)
+
+    def remove_wallpaper(self, wp_path):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM wallpapers WHERE path = ?', (wp_path,))
+
+    def get_wallpaper(self, wp_path):
+        with self.lock:
+            row = self.db.execute(
+                '''SELECT path, size, mtime_ns, width, height, thumbnail_key
+                FROM wallpapers WHERE path = ?''',
+                (wp_path,)
+            ).fetchone()
+        if not row:
+            return None
+        return dict(zip(
+            ('path', 'size', 'mtime_ns', 'width', 'height', 'thumbnail_key'),
+            row
+        ))
+
+    def fill_missing_dimensions(self):
+        '''
+        Reads the dimensions of the indexed wallpapers that don't have
+        them yet from their headers. Meant for a low priority worker,
+        stops early if the index gets closed meanwhile.
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            paths = [r[0] for r in self.db.execute(
+                'SELECT path FROM wallpapers WHERE width IS NULL'
+            )]
+        dimensions = []
+        for wp_path in paths:
+            if self.closed:
+                return
+            info = GdkPixbuf.Pixbuf.get_file_info(wp_path)
+            if info[0] is None:
+                # unknown format, don't try again
+                dimensions.append((0, 0, wp_path))
+            else:
+                dimensions.append((info[1], info[2], wp_path))
+        with self.lock:
+            if self.closed:
+                return
+            with self.db:
+                self.db.executemany(
+                    'UPDATE wallpapers SET width = ?, height = ? WHERE path = ?',
+                    dimensions
+                )
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.db.close()
@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+DEFAULT_MAX_SIZE_MB = 500
+DEFAULT_MAX_AGE_DAYS = 30
+INDEX_FILENAME = 'merge_cache_index.json'
+INDEX_LOCK_FILENAME = 'merge_cache_index.lock'
+MERGED_FILENAME_RE = re.compile(r'^([0-9a-f]{64})\.\w+$')
+# <key>.tmp.<random>.<ext>, or <key>.tmp.<ext> from older versions
+TEMP_FILENAME_RE = re.compile(r'^[0-9a-f]{64}\.tmp\.(\w+\.)?\w+$')
+# younger temporary files may be merges in progress in another process
+TEMP_MAX_AGE_S = 60 * 60
+
+
+class MergeCache:
+    '''
+    Keeps track of the merged wallpapers saved in the cache directory.
+    Entries are keyed by the monitor layout and the identity (path, mtime
+    and size) of every source image, so editing a source invalidates its
+    merges. An index of entry sizes and last use times is kept next to
+    them to evict by total size (max_size_mb) and by age (max_age_days),
+    a limit of 0 disabling the corresponding eviction.
+    get_protected_paths, if given, returns the paths that must never be
+    evicted, e.g. the wallpaper currently set on the desktop.
+    The UI, the daemon and the command line may all use the same cache
+    directory at once: the index is locked with flock while it's
+    updated, and the entries saved by the other processes are merged in
+    before saving it.
+    '''
+
+    def __init__(self, cache_path, max_size_mb=DEFAULT_MAX_SIZE_MB,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS, get_protected_paths=None):
+        self.cache_path = cache_path
+        self.get_protected_paths = get_protected_paths
+        self.index_path = '{0}/{1}'.format(cache_path, INDEX_FILENAME)
+        self.index_lock_path = '{0}/{1}'.format(cache_path, INDEX_LOCK_FILENAME)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        # held while merging, so that a merge for a key already being
+        # merged (e.g. pre-rendered) waits for it instead of redoing it
+        self.merge_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # key -> {'filename': str, 'size': int, 'created': float, 'last_used': float}
+        self.entries = {}
+        self.load_index()
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        '''
+        Holds self.lock and the index file lock, and brings self.entries
+        up to date with the saved index.
+        '''
+        with self.lock, open(self.index_lock_path, 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                self.merge_saved_index()
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def read_index(self):
+        if not os.path.isfile(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as fd:
+                return json.loads(fd.read())
+        except (OSError, ValueError):
+            print('Error: merge cache index is corrupted, starting over')
+            return {}
+
+    def merge_saved_index(self):
+        # must be called with the index locked
+        for key, entry in self.read_index().items():
+            own_entry = self.entries.get(key)
+            if not own_entry or entry['last_used'] > own_entry['last_used']:
+                self.entries[key] = entry
+        # drops what other processes evicted
+        for key, entry in list(self.entries.items()):
+            if not os.path.isfile('{0}/{1}'.format(self.cache_path, entry['filename'])):
+                self.entries.pop(key)
+
+    def load_index(self):
+        os.makedirs(self.cache_path, exist_ok=True)
+        with self.locked_index():
+            indexed_filenames = set(
+                entry['filename'] for entry in self.entries.values()
+            )
+            now = time.time()
+            with os.scandir(self.cache_path) as it:
+                for f in it:
+                    if not f.is_file():
+                        continue
+                    if TEMP_FILENAME_RE.match(f.name):
+                        # leftover of an interrupted merge
+                        if now - f.stat().st_mtime > TEMP_MAX_AGE_S:
+                            os.remove(f.path)
+                        continue
+                    match = MERGED_FILENAME_RE.match(f.name)
+                    if (
+                            match and
+                            f.name not in indexed_filenames and
+                            match.group(1) not in self.entries
+                    ):
+                        # saved before the cache had an index, and maybe
+                        # still the desktop wallpaper: adopt it, so that it
+                        # ages out like any other merge
+                        f_stat = f.stat()
+                        self.entries[match.group(1)] = {
+                            'filename': f.name,
+                            'size': f_stat.st_size,
+                            'created': f_stat.st_mtime,
+                            'last_used': f_stat.st_mtime
+                        }
+            self.evict()
+            self.save_index()
+
+    def save_index(self):
+        # must be called with the index locked
+        tmp_path = '{0}.tmp'.format(self.index_path)
+        with open(tmp_path, 'w') as fd:
+            fd.write(json.dumps(self.entries))
+        os.replace(tmp_path, self.index_path)
+
+    def get_key(self, monitors, *merge_options):
+        '''
+        merge_options are any additional parameters that affect the
+        merged output, they become part of the key.
+        '''
+        key_parts = ['HydraPaper']
+        for m in monitors:
+            try:
+                wp_stat = os.stat(m.wallpaper)
+                wp_identity = (wp_stat.st_mtime_ns, wp_stat.st_size)
+            except OSError:
+                wp_identity = None
+            key_parts.append(repr((
+                m.width, m.height, m.scaling, m.offset_x, m.offset_y,
+                m.wallpaper, wp_identity
+            )))
+        key_parts.extend(repr(o) for o in merge_options)
+        return hashlib.sha256('_'.join(key_parts).encode()).hexdigest()
+
+    def get_path(self, key, extension='png'):
+        return '{0}/{1}.{2}'.format(self.cache_path, key, extension)
+
+    def get_temp_path(self, key, extension='png'):
+        '''
+        Creates an empty file, unique to this merge, to merge key into.
+        The extension is kept last so that the format can be inferred.
+        '''
+        fd, path = tempfile.mkstemp(
+            prefix='{0}.tmp.'.format(key),
+            suffix='.{0}'.format(extension),
+            dir=self.cache_path
+        )
+        os.close(fd)
+        return path
+
+    def discard_temp(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, key, count=True):
+        '''
+        Returns the path of the cached merge for key, or None on a miss.
+        Only lookups with count set add up to the hit and miss stats.
+        '''
+        with self.locked_index():
+            entry = self.entries.get(key)
+            if entry:
+                path = '{0}/{1}'.format(self.cache_path, entry['filename'])
+                if os.path.isfile(path):
+                    if count:
+                        self.hits += 1
+                    entry['last_used'] = time.time()
+                    self.save_index()
+                    return path
+                self.entries.pop(key)
+            if count:
+                self.misses += 1
+            return None
+
+    def store(self, key, tmp_path, extension='png'):
+        '''
+        Moves a freshly merged wallpaper from tmp_path into the cache and
+        returns its final path.
+        '''
+        path = self.get_path(key, extension)
+        os.replace(tmp_path, path)
+        now = time.time()
+        with self.locked_index():
+            self.entries[key] = {
+                'filename': os.path.basename(path),
+                'size': os.path.getsize(path),
+                'created': now,
+                'last_used': now
+            }
+            # never evict the merge that's about to be applied
+            self.evict(keep=key)
+            self.save_index()
+        return path
+
+    def evict(self, keep=None):
+        # must be called with the index locked
+        now = time.time()
+        by_last_use = sorted(
+            self.entries.items(), key=lambda e: e[1]['last_used']
+        )
+        total_size = sum(e['size'] for e in self.entries.values())
+        # the most recently used merge is likely the current desktop
+        # wallpaper, deleting it would leave the desktop blank
+        if by_last_use:
+            newest = by_last_use[-1][0]
+        else:
+            newest = None
+        protected_paths = set()
+        if self.get_protected_paths:
+            protected_paths = set(self.get_protected_paths())
+        for key, entry in by_last_use:
+            if key in (keep, newest):
+                continue
+            path = '{0}/{1}'.format(self.cache_path, entry['filename'])
+            if path in protected_paths:
+                continue
+            too_old = self.max_age and now - entry['last_used'] > self.max_age
+            too_big = self.max_size and total_size > self.max_size
+            if not too_old and not too_big:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= entry['size']
+            self.entries.pop(key)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'size': sum(e['size'] for e in self.entries.values())
+            }
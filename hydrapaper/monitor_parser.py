@@ -1,7 +1,3 @@
-import gi
-gi.require_version('Gdk', '3.0')
-from gi.repository import Gdk
-
 class Monitor:
 
     def __init__(self, width, height, scaling, offset_x, offset_y, index, name, primary=False):
@@ -25,9 +21,45 @@ HydraPaper Monitor Object
 - Wallpaper path: {};
 '''.format(self.name, self.width, self.height, self.scaling, self.offset_x, self.offset_y, self.wallpaper)
 
+    def to_dict(self):
+        # the geometry only, wallpapers are saved by monitor name
+        return {
+            'width': self.width,
+            'height': self.height,
+            'scaling': self.scaling,
+            'offset_x': self.offset_x,
+            'offset_y': self.offset_y,
+            'index': self.index,
+            'name': self.name,
+            'primary': self.primary
+        }
+
+def build_monitors_from_config(monitors_layout):
+    '''
+    Rebuilds the monitors saved with Monitor.to_dict, so that they can
+    be known without a display connection (e.g. by the command line).
+    '''
+    monitors = []
+    for m in monitors_layout:
+        monitors.append(Monitor(
+            m['width'],
+            m['height'],
+            m['scaling'],
+            m['offset_x'],
+            m['offset_y'],
+            m['index'],
+            m['name'],
+            m['primary']
+        ))
+    return monitors
+
 def build_monitors_from_gdk():
     monitors = []
     try:
+        # imported here so that the command line doesn't need Gdk
+        import gi
+        gi.require_version('Gdk', '3.0')
+        from gi.repository import Gdk
         display = Gdk.Display.get_default()
         num_monitors = display.get_n_monitors()
         for i in range(0, num_monitors):
@@ -0,0 +1,91 @@
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf
+
+# Previews are derived from the grid thumbnails (thumbnail_cache), never
+# from the full size wallpapers, so they cost a scale of a small pixbuf.
+
+MONITOR_PREVIEW_SIZE = 64
+LAYOUT_PREVIEW_MAX_WIDTH = 480
+LAYOUT_PREVIEW_MAX_HEIGHT = 96
+# RGBA
+LAYOUT_BACKGROUND_COLOR = 0x00000000
+MISSING_WALLPAPER_COLOR = 0x555753ff
+
+
+def scale_to_fit(pixbuf, size=MONITOR_PREVIEW_SIZE):
+    '''
+    Scales pixbuf to fit in a size x size square, keeping its aspect ratio.
+    '''
+    scale = min(size / pixbuf.get_width(), size / pixbuf.get_height())
+    return pixbuf.scale_simple(
+        max(1, round(pixbuf.get_width() * scale)),
+        max(1, round(pixbuf.get_height() * scale)),
+        GdkPixbuf.InterpType.BILINEAR
+    )
+
+
+def fit_pixbuf(pixbuf, width, height):
+    '''
+    Crops pixbuf to the aspect ratio of width x height, centered, and
+    scales it to that size. Same as wallpaper_merger.get_fit_box and
+    PIL.ImageOps.fit, so the preview matches the merge.
+    '''
+    src_width = pixbuf.get_width()
+    src_height = pixbuf.get_height()
+    target_ratio = width / height
+    if src_width / src_height > target_ratio:
+        crop_width = max(1, round(src_height * target_ratio))
+        crop_height = src_height
+    else:
+        crop_width = src_width
+        crop_height = max(1, round(src_width / target_ratio))
+    cropped = pixbuf.new_subpixbuf(
+        (src_width - crop_width) // 2,
+        (src_height - crop_height) // 2,
+        crop_width,
+        crop_height
+    )
+    return cropped.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+
+
+def render_layout_preview(monitors, pixbufs,
+                          max_width=LAYOUT_PREVIEW_MAX_WIDTH,
+                          max_height=LAYOUT_PREVIEW_MAX_HEIGHT):
+    '''
+    Composes the wallpapers of monitors at their position in the spanned
+    image, like wallpaper_merger.multi_setup_pillow, scaled down to fit
+    max_width x max_height. pixbufs maps monitor names to the thumbnail
+    of their wallpaper, monitors without one are filled with a plain
+    color. Returns None if there's nothing to render.
+    '''
+    if not monitors:
+        return None
+    canvas_width = max([m.offset_x + m.width * m.scaling for m in monitors])
+    canvas_height = max([m.offset_y + m.height * m.scaling for m in monitors])
+    scale = min(max_width / canvas_width, max_height / canvas_height)
+    canvas = GdkPixbuf.Pixbuf.new(
+        GdkPixbuf.Colorspace.RGB, True, 8,
+        max(1, round(canvas_width * scale)),
+        max(1, round(canvas_height * scale))
+    )
+    canvas.fill(LAYOUT_BACKGROUND_COLOR)
+    for m in monitors:
+        x = round(m.offset_x * scale)
+        y = round(m.offset_y * scale)
+        width = max(1, min(
+            round(m.width * m.scaling * scale), canvas.get_width() - x
+        ))
+        height = max(1, min(
+            round(m.height * m.scaling * scale), canvas.get_height() - y
+        ))
+        pixbuf = pixbufs.get(m.name)
+        if pixbuf is None:
+            # a subpixbuf shares the canvas pixels
+            canvas.new_subpixbuf(x, y, width, height).fill(MISSING_WALLPAPER_COLOR)
+            continue
+        tile = fit_pixbuf(pixbuf, width, height)
+        if not tile.get_has_alpha():
+            tile = tile.add_alpha(False, 0, 0, 0)
+        tile.copy_area(0, 0, width, height, canvas, x, y)
+    return canvas
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import atexit
+import cProfile
+import threading
+import contextlib
+
+# Opt-in instrumentation. Spans are recorded as Chrome trace events, the
+# resulting file can be loaded in Perfetto (ui.perfetto.dev) or
+# chrome://tracing. Operations can additionally be run under cProfile,
+# one .prof file per run, to be read with pstats or snakeviz.
+# Enabled by the HYDRAPAPER_TRACE (trace file path) and
+# HYDRAPAPER_PROFILE (cProfile dumps directory) environment variables,
+# or the --trace and --profile command line options.
+# When disabled, span() and operation() cost a single attribute check.
+
+TRACE_ENV = 'HYDRAPAPER_TRACE'
+PROFILE_ENV = 'HYDRAPAPER_PROFILE'
+
+
+class Profiler:
+
+    def __init__(self):
+        self.trace_path = None
+        self.profile_dir = None
+        self.tracing = False
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        # held by the operation being profiled, only one profiler can be
+        # active at a time (Python >= 3.12 raises otherwise)
+        self.profile_lock = threading.Lock()
+        self.profile_counter = 0
+        self.pid = os.getpid()
+
+    def enable(self, trace_path=None, profile_dir=None):
+        if trace_path:
+            if not self.tracing:
+                atexit.register(self.save)
+            self.trace_path = trace_path
+            self.tracing = True
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+            self.profile_dir = profile_dir
+
+    def add_complete_event(self, name, start, end, args=None):
+        '''
+        Records a span of name from start to end (time.monotonic values),
+        useful for work that begins and ends in different callbacks.
+        '''
+        if not self.tracing:
+            return
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': start * 1000000,
+            'dur': (end - start) * 1000000,
+            'pid': self.pid,
+            'tid': thread.ident
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+            if thread.ident not in self.thread_names:
+                self.thread_names[thread.ident] = thread.name
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.tracing:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_complete_event(name, start, time.monotonic(), args)
+
+    @contextlib.contextmanager
+    def operation(self, name, **args):
+        '''
+        A top level span, also run under cProfile if enabled and no
+        other operation is being profiled at the same time.
+        '''
+        if not self.profile_dir or not self.profile_lock.acquire(blocking=False):
+            with self.span(name, **args):
+                yield
+            return
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiling tool is active (e.g. python -m cProfile)
+                profile = None
+            if not profile:
+                with self.span(name, **args):
+                    yield
+                return
+            with self.lock:
+                self.profile_counter += 1
+                dump_path = '{0}/{1}-{2}-{3}.prof'.format(
+                    self.profile_dir, name.replace(' ', '_'),
+                    self.pid, self.profile_counter
+                )
+            with self.span(name, **args):
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    profile.dump_stats(dump_path)
+        finally:
+            self.profile_lock.release()
+
+    def save(self):
+        if not self.tracing:
+            return
+        with self.lock:
+            events = list(self.events)
+            events.extend({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': self.pid,
+                'tid': tid,
+                'args': {'name': thread_name}
+            } for tid, thread_name in self.thread_names.items())
+        tmp_path = '{0}.tmp'.format(self.trace_path)
+        try:
+            with open(tmp_path, 'w') as fd:
+                json.dump({
+                    'traceEvents': events,
+                    'displayTimeUnit': 'ms'
+                }, fd)
+            os.replace(tmp_path, self.trace_path)
+        except OSError as e:
+            print('Error: cannot save trace to {0}: {1}'.format(self.trace_path, e))
+
+
+profiler = Profiler()
+profiler.enable(
+    os.environ.get(TRACE_ENV),
+    os.environ.get(PROFILE_ENV)
+)
+span = profiler.span
+operation = profiler.operation
+
+
+def now():
+    return time.monotonic()
+
+
+def add_argparse_arguments(parser):
+    parser.add_argument(
+        '--trace', dest='trace', metavar='FILE',
+        help='record timings as a Chrome trace event file (also ${0})'.format(TRACE_ENV)
+    )
+    parser.add_argument(
+        '--profile', dest='profile', metavar='DIR',
+        help='dump a cProfile of every operation to DIR (also ${0})'.format(PROFILE_ENV)
+    )
+
+
+def enable_from_args(args):
+    profiler.enable(args.trace, args.profile)
+
+
+class StartupTimer:
+    '''
+    Records how long each startup phase took, phases being the time
+    between two consecutive marks, and prints them in a single report.
+    The phases also become trace spans, even if tracing is only enabled
+    after some of them (e.g. by a command line option).
+    '''
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time or time.monotonic()
+        self.last_time = self.start_time
+        self.phases = []
+        self.reported = False
+
+    def mark(self, phase):
+        if self.reported:
+            return  # startup is over
+        now = time.monotonic()
+        self.phases.append((phase, self.last_time, now))
+        self.last_time = now
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        for phase, start, end in self.phases:
+            profiler.add_complete_event(
+                'startup: {0}'.format(phase), start, end
+            )
+        print('Startup: {0} (total {1:.3f}s)'.format(
+            ', '.join(
+                '{0} {1:.3f}s'.format(phase, end - start)
+                for phase, start, end in self.phases
+            ),
+            self.last_time - self.start_time
+        ))
@@ -0,0 +1,218 @@
+import os
+import signal
+
+from gi.repository import GLib, Gio
+
+from . import config_store as ConfigStore
+from . import monitor_parser as MonitorParser
+from . import merge_cache as MergeCache
+from . import wallpaper_merger as WallpaperMerger
+from . import task_scheduler as TaskScheduler
+from . import thumbnail_cache as ThumbnailCache
+from . import library_index as LibraryIndex
+from . import wallpaper_scanner as WallpaperScanner
+
+BUS_NAME = 'org.gabmus.hydrapaper.Daemon'
+OBJECT_PATH = '/org/gabmus/hydrapaper/Daemon'
+INTERFACE_NAME = 'org.gabmus.hydrapaper.Daemon'
+ERROR_NAME = 'org.gabmus.hydrapaper.Daemon.Error'
+
+INTERFACE_XML = '''
+<node>
+  <interface name="org.gabmus.hydrapaper.Daemon">
+    <method name="Apply">
+      <arg type="s" name="wallpaper" direction="out"/>
+    </method>
+    <method name="SetMonitorWallpaper">
+      <arg type="s" name="monitor" direction="in"/>
+      <arg type="s" name="wallpaper" direction="in"/>
+    </method>
+    <method name="ListMonitors">
+      <arg type="as" name="monitors" direction="out"/>
+    </method>
+    <method name="ListLibrary">
+      <arg type="as" name="wallpapers" direction="out"/>
+    </method>
+    <method name="PreRender">
+      <arg type="s" name="wallpaper" direction="out"/>
+    </method>
+    <method name="GetThumbnail">
+      <arg type="s" name="wallpaper" direction="in"/>
+      <arg type="s" name="thumbnail" direction="out"/>
+    </method>
+  </interface>
+</node>
+'''
+
+
+class Service:
+    '''
+    Resident HydraPaper process, owning BUS_NAME on the session bus.
+    Keeps the library index, the caches and the monitor layout loaded,
+    so that repeated operations don't pay for the process startup, the
+    cache indexes or a rescan. Doesn't use Gtk.
+    Slow methods run on a TaskScheduler and reply once done, so the
+    service keeps answering meanwhile.
+    '''
+
+    def __init__(self):
+        self.main_loop = GLib.MainLoop()
+        self.config_store = ConfigStore.ConfigStore()
+        self.configuration = self.config_store.load()
+        self.task_scheduler = TaskScheduler.TaskScheduler()
+        self.thumbnail_cache = ThumbnailCache.ThumbnailCache(
+            ConfigStore.CACHE_PATH,
+            self.configuration['thumbnail_cache_max_size_mb']
+        )
+        self.merge_cache = MergeCache.MergeCache(
+            ConfigStore.CACHE_PATH,
+            self.configuration['merge_cache_max_size_mb'],
+            self.configuration['merge_cache_max_age_days'],
+            WallpaperMerger.get_current_wallpapers
+        )
+        self.tile_cache = WallpaperMerger.TileCache()
+        self.library_index = LibraryIndex.LibraryIndex(
+            ConfigStore.CACHE_PATH,
+            self.thumbnail_cache
+        )
+        self.node_info = Gio.DBusNodeInfo.new_for_xml(INTERFACE_XML)
+        # method name -> (function, output signature, runs in a worker)
+        self.methods = {
+            'Apply': (self.apply, '(s)', True),
+            'SetMonitorWallpaper': (self.set_monitor_wallpaper, None, False),
+            'ListMonitors': (self.list_monitors, '(as)', False),
+            'ListLibrary': (self.list_library, '(as)', True),
+            'PreRender': (self.pre_render, '(s)', True),
+            'GetThumbnail': (self.get_thumbnail, '(s)', True),
+        }
+        self.owner_id = None
+        self.registration_id = None
+
+    def run(self):
+        self.owner_id = Gio.bus_own_name(
+            Gio.BusType.SESSION,
+            BUS_NAME,
+            Gio.BusNameOwnerFlags.NONE,
+            self.on_bus_acquired,
+            None,
+            self.on_name_lost
+        )
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, self.quit)
+        self.main_loop.run()
+        Gio.bus_unown_name(self.owner_id)
+        # the workers may still be using the library index
+        self.task_scheduler.shutdown(wait=True)
+        self.library_index.close()
+        self.config_store.flush()
+
+    def quit(self, *args):
+        self.main_loop.quit()
+        return False  # remove the signal source
+
+    def on_bus_acquired(self, connection, name):
+        self.registration_id = connection.register_object(
+            OBJECT_PATH,
+            self.node_info.interfaces[0],
+            self.on_method_call,
+            None,
+            None
+        )
+
+    def on_name_lost(self, connection, name):
+        print('Error: cannot own {0} on the session bus, is another instance running?'.format(name))
+        self.quit()
+
+    def on_method_call(self, connection, sender, object_path, interface_name,
+                       method_name, parameters, invocation):
+        if method_name not in self.methods:
+            invocation.return_dbus_error(
+                'org.freedesktop.DBus.Error.UnknownMethod',
+                'No such method {0}'.format(method_name)
+            )
+            return
+        function, out_signature, in_worker = self.methods[method_name]
+        # pick up changes saved by the UI in the meantime
+        self.configuration = self.config_store.reload()
+
+        def on_done(result):
+            if out_signature:
+                invocation.return_value(GLib.Variant(out_signature, (result,)))
+            else:
+                invocation.return_value(None)
+
+        def on_error(exc):
+            invocation.return_dbus_error(ERROR_NAME, str(exc))
+
+        args = parameters.unpack()
+        if not in_worker:
+            try:
+                result = function(*args)
+            except Exception as e:
+                on_error(e)
+                return
+            on_done(result)
+            return
+        self.task_scheduler.submit(
+            function, *args,
+            callback=on_done,
+            error_callback=on_error,
+            priority=TaskScheduler.PRIORITY_HIGH
+        )
+
+    def get_monitors(self):
+        monitors = MonitorParser.build_monitors_from_config(
+            self.configuration['monitors_layout']
+        )
+        if not monitors:
+            raise ValueError('no monitor layout saved, start HydraPaper once to save it')
+        for m in monitors:
+            m.wallpaper = self.configuration['monitors'].get(m.name)
+            if not m.wallpaper:
+                raise ValueError('no wallpaper set for {0}'.format(m.name))
+        return monitors
+
+    def apply(self):
+        return WallpaperMerger.apply_wallpapers(
+            self.get_monitors(), self.merge_cache, self.configuration,
+            self.tile_cache
+        )
+
+    def pre_render(self):
+        # merges (or finds in the cache) without changing the wallpaper
+        monitors = self.get_monitors()
+        if len(monitors) == 1:
+            return monitors[0].wallpaper
+        return WallpaperMerger.merge_wallpapers_cached(
+            monitors, self.merge_cache, self.configuration, self.tile_cache
+        )
+
+    def set_monitor_wallpaper(self, monitor_name, wp_path):
+        if monitor_name not in [
+                m['name'] for m in self.configuration['monitors_layout']
+        ]:
+            raise ValueError('unknown monitor {0}'.format(monitor_name))
+        # same check as the UI, a bad path would only fail at the next apply
+        if not (WallpaperScanner.is_image_filename(wp_path) and os.path.isfile(wp_path)):
+            raise ValueError('{0} is not an image file'.format(wp_path))
+        self.configuration['monitors'][monitor_name] = wp_path
+        # written right away, the UI reads it at startup
+        self.config_store.flush()
+
+    def list_monitors(self):
+        return [m['name'] for m in self.configuration['monitors_layout']]
+
+    def list_library(self):
+        # only the directories that changed since the last scan get listed
+        return self.library_index.scan(
+            [path_dict['path'] for path_dict in self.configuration['wallpapers_paths']],
+            self.configuration['recursive_scan']
+        )
+
+    def get_thumbnail(self, wp_path):
+        return self.thumbnail_cache.get_thumbnail_file(wp_path)
+
+
+def main():
+    Service().run()
+    return 0
@@ -0,0 +1,160 @@
+import os
+import heapq
+import itertools
+import threading
+import traceback
+from concurrent.futures import Future
+
+from gi.repository import GLib
+
+# lower values run first, same convention as GLib source priorities
+PRIORITY_HIGH = GLib.PRIORITY_HIGH
+PRIORITY_DEFAULT = GLib.PRIORITY_DEFAULT
+PRIORITY_LOW = GLib.PRIORITY_LOW
+
+
+def idle_add(function, *args, priority=PRIORITY_DEFAULT):
+    '''
+    Schedules function(*args) in the GLib main loop, ordered with the
+    completion callbacks of tasks of the same priority. Safe to call
+    from worker threads.
+    Completion callbacks are idle sources shifted by the task priority,
+    so that a flood of finished tasks can't starve redraws.
+    '''
+    def run_once():
+        function(*args)
+        return False  # remove the idle source
+    return GLib.idle_add(run_once, priority=GLib.PRIORITY_DEFAULT_IDLE + priority)
+
+
+class Task:
+    '''
+    A unit of work queued on a TaskScheduler. Wraps a
+    concurrent.futures.Future; the completion callback runs in the GLib
+    main loop, so it can safely touch widgets.
+    '''
+
+    def __init__(self, function, args, callback, error_callback, priority):
+        self.function = function
+        self.args = args
+        self.callback = callback
+        self.error_callback = error_callback
+        self.priority = priority
+        self.future = Future()
+        self.cancel_requested = False
+
+    def cancel(self):
+        '''
+        Cancels the task. A queued task never runs; a running task is
+        left to finish (long tasks may poll is_cancelled) but its
+        callbacks are not called.
+        '''
+        self.cancel_requested = True
+        return self.future.cancel()
+
+    def is_cancelled(self):
+        return self.cancel_requested
+
+    def done(self):
+        return self.future.done()
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.function(*self.args)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+    def dispatch(self):
+        # runs in the main loop
+        if self.cancel_requested or self.future.cancelled():
+            return False
+        exc = self.future.exception()
+        if exc:
+            if self.error_callback:
+                self.error_callback(exc)
+            else:
+                print('Error: task {0} failed'.format(self.function.__name__))
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+        elif self.callback:
+            self.callback(self.future.result())
+
+
+class TaskScheduler:
+    '''
+    Runs functions on a bounded pool of worker threads, most urgent
+    priority first, and reports completion through GLib main loop
+    callbacks instead of blocking the caller.
+    '''
+
+    def __init__(self, max_workers=None, name='HydraPaperWorker'):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.name = name
+        self.queue = []
+        self.counter = itertools.count()  # keeps FIFO order within a priority
+        self.condition = threading.Condition()
+        self.workers = []
+        self.idle_workers = 0
+        self.is_shutdown = False
+
+    def submit(self, function, *args, callback=None, error_callback=None,
+               priority=PRIORITY_DEFAULT):
+        task = Task(function, args, callback, error_callback, priority)
+        task.future.add_done_callback(
+            lambda f: idle_add(task.dispatch, priority=priority)
+        )
+        with self.condition:
+            if self.is_shutdown:
+                raise RuntimeError('cannot submit tasks after shutdown')
+            heapq.heappush(self.queue, (priority, next(self.counter), task))
+            if (
+                    len(self.queue) > self.idle_workers and
+                    len(self.workers) < self.max_workers
+            ):
+                self.spawn_worker()
+            self.condition.notify()
+        return task
+
+    def spawn_worker(self):
+        # must be called with self.condition held
+        worker = threading.Thread(
+            target=self.worker_loop,
+            name='{0}-{1}'.format(self.name, len(self.workers)),
+            daemon=True
+        )
+        self.workers.append(worker)
+        worker.start()
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                self.idle_workers += 1
+                while not self.queue and not self.is_shutdown:
+                    self.condition.wait()
+                self.idle_workers -= 1
+                if self.is_shutdown:
+                    return
+                task = heapq.heappop(self.queue)[2]
+            task.run()
+
+    def shutdown(self, wait=False):
+        '''
+        Cancels every queued task and stops the workers once their
+        current task is done. With wait, blocks until the running tasks
+        are over, so that what they use can be closed afterwards.
+        '''
+        with self.condition:
+            self.is_shutdown = True
+            for _, _, task in self.queue:
+                task.cancel()
+            self.queue = []
+            self.condition.notify_all()
+            workers = list(self.workers)
+        if wait:
+            for worker in workers:
+                # a task may shut its own scheduler down
+                if worker is not threading.current_thread():
+                    worker.join()
@@ -0,0 +1,192 @@
+import os
+import pathlib
+import hashlib
+import threading
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GLib, GdkPixbuf
+
+from . import profiling as Profiling
+
+THUMBNAIL_SIZE = 250
+# thumbnails up to 256x256 belong to the 'large' flavor of the
+# freedesktop thumbnail spec
+THUMBNAIL_FLAVOR = 'large'
+DEFAULT_MAX_SIZE_MB = 512
+
+
+def get_shared_thumbnails_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or '{0}/.cache'.format(
+        os.environ.get('HOME')
+    )
+    return '{0}/thumbnails/{1}'.format(cache_home, THUMBNAIL_FLAVOR)
+
+
+class ThumbnailCache:
+    '''
+    On-disk thumbnail store laid out like the freedesktop thumbnail spec:
+    files are named after the md5 of the source uri and carry the source
+    mtime and size in their Thumb::MTime and Thumb::Size png text chunks,
+    so a thumbnail is only reused if the source file is unchanged.
+    Thumbnails already generated by other applications in the shared
+    ~/.cache/thumbnails directory are reused read-only.
+    The store is capped at max_size_mb, least recently used first out.
+    '''
+
+    def __init__(self, cache_path, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.thumbnails_path = '{0}/thumbnails/{1}'.format(
+            cache_path, THUMBNAIL_FLAVOR
+        )
+        self.shared_thumbnails_path = get_shared_thumbnails_path()
+        self.max_size = max_size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        # thumbnail filename -> [size in bytes, last use timestamp]
+        self.entries = None
+        self.total_size = 0
+
+    def get_key(self, wp_path):
+        return hashlib.md5(
+            pathlib.Path(wp_path).absolute().as_uri().encode()
+        ).hexdigest()
+
+    def get_thumbnail_path(self, wp_path):
+        return '{0}/{1}.png'.format(self.thumbnails_path, self.get_key(wp_path))
+
+    def load_index(self):
+        # must be called with self.lock held
+        if self.entries is not None:
+            return
+        self.entries = {}
+        self.total_size = 0
+        if not os.path.isdir(self.thumbnails_path):
+            os.makedirs(self.thumbnails_path, exist_ok=True)
+            return
+        with os.scandir(self.thumbnails_path) as it:
+            for entry in it:
+                if not entry.name.endswith('.png'):
+                    continue
+                st = entry.stat()
+                self.entries[entry.name] = [st.st_size, st.st_mtime]
+                self.total_size += st.st_size
+
+    def is_valid_for(self, pixbuf, wp_stat):
+        return (
+            pixbuf.get_option('tEXt::Thumb::MTime') == str(int(wp_stat.st_mtime)) and
+            pixbuf.get_option('tEXt::Thumb::Size') in (None, str(wp_stat.st_size))
+        )
+
+    def load_thumbnail(self, thumb_path, wp_stat):
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumb_path)
+        except GLib.Error:
+            return None
+        if not self.is_valid_for(pixbuf, wp_stat):
+            return None
+        return pixbuf
+
+    def touch(self, thumb_path):
+        # the thumbnail file mtime doubles as its last use timestamp
+        name = os.path.basename(thumb_path)
+        try:
+            os.utime(thumb_path)
+        except OSError:
+            return
+        with self.lock:
+            self.load_index()
+            if name in self.entries:
+                self.entries[name][1] = os.path.getmtime(thumb_path)
+
+    def store(self, wp_path, wp_stat, pixbuf):
+        thumb_path = self.get_thumbnail_path(wp_path)
+        tmp_path = '{0}.{1}.tmp'.format(thumb_path, threading.get_ident())
+        with self.lock:
+            self.load_index()
+        try:
+            pixbuf.savev(
+                tmp_path, 'png',
+                [
+                    'tEXt::Thumb::URI',
+                    'tEXt::Thumb::MTime',
+                    'tEXt::Thumb::Size'
+                ],
+                [
+                    pathlib.Path(wp_path).absolute().as_uri(),
+                    str(int(wp_stat.st_mtime)),
+                    str(wp_stat.st_size)
+                ]
+            )
+            os.replace(tmp_path, thumb_path)
+        except (GLib.Error, OSError):
+            print('Error: could not write thumbnail for {0}'.format(wp_path))
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return
+        st = os.stat(thumb_path)
+        name = os.path.basename(thumb_path)
+        with self.lock:
+            if name in self.entries:
+                self.total_size -= self.entries[name][0]
+            self.entries[name] = [st.st_size, st.st_mtime]
+            self.total_size += st.st_size
+            if self.total_size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # must be called with self.lock held
+        # drop least recently used thumbnails down to 90% of the cap,
+        # so that a full cache doesn't evict on every single store
+        target = self.max_size * 0.9
+        for name, (size, last_use) in sorted(
+                self.entries.items(), key=lambda e: e[1][1]
+        ):
+            if self.total_size <= target:
+                break
+            try:
+                os.remove('{0}/{1}'.format(self.thumbnails_path, name))
+            except FileNotFoundError:
+                pass
+            self.total_size -= size
+            self.entries.pop(name)
+
+    def get_pixbuf(self, wp_path):
+        '''
+        Returns a pixbuf of the wallpaper scaled to THUMBNAIL_SIZE, reading
+        it from the cache if possible and generating it otherwise.
+        Safe to call from worker threads.
+        '''
+        wp_stat = os.stat(wp_path)
+        thumb_path = self.get_thumbnail_path(wp_path)
+        pixbuf = self.load_thumbnail(thumb_path, wp_stat)
+        if pixbuf:
+            self.touch(thumb_path)
+            return pixbuf
+        pixbuf = self.load_thumbnail(
+            '{0}/{1}'.format(
+                self.shared_thumbnails_path, os.path.basename(thumb_path)
+            ),
+            wp_stat
+        )
+        if pixbuf:
+            return pixbuf
+        with Profiling.span('decode thumbnail'):
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                wp_path, THUMBNAIL_SIZE, THUMBNAIL_SIZE, True
+            )
+        with Profiling.span('store thumbnail'):
+            self.store(wp_path, wp_stat, pixbuf)
+        return pixbuf
+
+    def get_thumbnail_file(self, wp_path):
+        '''
+        Returns the path of a valid thumbnail file for the wallpaper,
+        generating it if needed, for other processes to read.
+        '''
+        self.get_pixbuf(wp_path)
+        thumb_path = self.get_thumbnail_path(wp_path)
+        if os.path.isfile(thumb_path):
+            return thumb_path
+        # served from the shared thumbnails, which aren't copied
+        return '{0}/{1}'.format(
+            self.shared_thumbnails_path, os.path.basename(thumb_path)
+        )
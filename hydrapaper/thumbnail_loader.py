@@ -0,0 +1,45 @@
+from . import task_scheduler as TaskScheduler
+from . import profiling as Profiling
+
+
+class ThumbnailLoader:
+    '''
+    Decodes wallpaper thumbnails on a pool of worker threads sized to the
+    number of cores. Pixbuf decoding releases the GIL, so the workers run
+    truly in parallel. Results are handed back to the Gtk main loop, so
+    callbacks can safely touch widgets.
+    '''
+
+    def __init__(self, thumbnail_cache, max_workers=None):
+        self.thumbnail_cache = thumbnail_cache
+        self.scheduler = TaskScheduler.TaskScheduler(
+            max_workers,
+            'HydraPaperThumbnailer'
+        )
+
+    def load(self, wp_path):
+        # runs in a worker thread
+        with Profiling.span('load thumbnail', path=wp_path):
+            return self.thumbnail_cache.get_pixbuf(wp_path)
+
+    def request(self, wp_path, callback, priority=TaskScheduler.PRIORITY_DEFAULT):
+        '''
+        Queues wp_path for decoding. callback(pixbuf) is called in the
+        main loop once done, with None if the image couldn't be decoded.
+        Returns the queued task, which can be cancelled.
+        '''
+        def on_error(exc):
+            print('Error: could not load thumbnail for {0}: {1}'.format(
+                wp_path, exc
+            ))
+            callback(None)
+
+        return self.scheduler.submit(
+            self.load, wp_path,
+            callback=callback,
+            error_callback=on_error,
+            priority=priority
+        )
+
+    def shutdown(self):
+        self.scheduler.shutdown()
@@ -0,0 +1,124 @@
+import bisect
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, GLib
+
+from . import task_scheduler as TaskScheduler
+
+# distances are in viewport heights, measured from the visible area
+PRELOAD_MARGIN = 1
+UNLOAD_MARGIN = 3
+UPDATE_DELAY_MS = 50
+
+
+class ViewportThumbnailLoader:
+    '''
+    Loads thumbnails only for the WallpaperBox children of a flowbox that
+    are visible or close to the visible area of its scrolled window, and
+    drops the pixbufs of children that scroll far away (or get hidden),
+    so that memory and startup time don't grow with the library size.
+    '''
+
+    def __init__(self, flowbox):
+        self.flowbox = flowbox
+        self.scrolled_window = flowbox.get_ancestor(Gtk.ScrolledWindow)
+        self.vadjustment = self.scrolled_window.get_vadjustment()
+        # children in layout order with their vertical position in the
+        # flowbox, rebuilt on relayout only, not on every scroll
+        self.layout_children = []
+        self.layout_tops = []
+        self.layout_valid = False
+        # children that have a thumbnail or a pending request for one
+        self.loaded_children = set()
+        self.update_source = None
+
+        self.vadjustment.connect('value-changed', self.queue_update)
+        self.flowbox.connect('size-allocate', self.invalidate_layout)
+        self.flowbox.connect('map', self.invalidate_layout)
+        self.flowbox.connect('unmap', self.queue_update)
+        # the flowbox destroys the children of removed model items itself
+        self.flowbox.connect('remove', self.on_child_removed)
+
+    def invalidate_layout(self, *args):
+        self.layout_valid = False
+        self.queue_update()
+
+    def queue_update(self, *args):
+        if self.update_source is None:
+            self.update_source = GLib.timeout_add(UPDATE_DELAY_MS, self.update)
+
+    def forget(self, child):
+        # to be called when a child gets removed from the flowbox
+        self.loaded_children.discard(child)
+
+    def on_child_removed(self, flowbox, child):
+        self.forget(child)
+        self.invalidate_layout()
+
+    def build_layout(self):
+        self.layout_children = []
+        self.layout_tops = []
+        for child in self.flowbox.get_children():
+            if not child.get_visible():
+                continue
+            coords = child.translate_coordinates(self.flowbox, 0, 0)
+            if coords is None:
+                continue
+            self.layout_children.append(child)
+            self.layout_tops.append(coords[1])
+        self.layout_valid = True
+
+    def update(self):
+        self.update_source = None
+        if not self.flowbox.get_mapped():
+            # not on screen (e.g. the other stack page), keep nothing around
+            for child in self.loaded_children:
+                child.unload_wallpaper_thumb()
+            self.loaded_children.clear()
+            return False
+        if not self.layout_valid:
+            self.build_layout()
+        value = self.vadjustment.get_value()
+        page_size = self.vadjustment.get_page_size()
+
+        # children starting above the range may still reach into it,
+        # so extend the top by one row worth of slack
+        row_slack = max(
+            [c.get_allocated_height() for c in self.layout_children[:1]] or [0]
+        )
+        visible_top = value - row_slack
+        visible_bottom = value + page_size
+        load_top = visible_top - page_size * PRELOAD_MARGIN
+        load_bottom = visible_bottom + page_size * PRELOAD_MARGIN
+        unload_top = visible_top - page_size * UNLOAD_MARGIN
+        unload_bottom = visible_bottom + page_size * UNLOAD_MARGIN
+
+        start = bisect.bisect_left(self.layout_tops, load_top)
+        end = bisect.bisect_right(self.layout_tops, load_bottom)
+        in_load_range = set(self.layout_children[start:end])
+
+        for child in list(self.loaded_children):
+            if child not in in_load_range:
+                if not child.get_visible():
+                    child.unload_wallpaper_thumb()
+                    self.loaded_children.discard(child)
+                    continue
+                coords = child.translate_coordinates(self.flowbox, 0, 0)
+                if coords is None or not unload_top <= coords[1] <= unload_bottom:
+                    child.unload_wallpaper_thumb()
+                    self.loaded_children.discard(child)
+                else:
+                    # close enough to keep, but not worth decoding now
+                    child.cancel_wallpaper_thumb()
+
+        for child, top in zip(
+                self.layout_children[start:end], self.layout_tops[start:end]
+        ):
+            if visible_top <= top <= visible_bottom:
+                priority = TaskScheduler.PRIORITY_HIGH
+            else:
+                priority = TaskScheduler.PRIORITY_DEFAULT
+            child.set_wallpaper_thumb(priority)
+            self.loaded_children.add(child)
+        return False  # remove the timeout source
@@ -18,17 +18,20 @@
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gdk, Gio, GdkPixbuf
-from . import threading_helper as ThreadingHelper
+from . import task_scheduler as TaskScheduler
 
 class WallpaperBox(Gtk.FlowBoxChild):
 
-    def __init__(self, wp_path, *args, **kwds):
+    def __init__(self, wp_path, thumbnail_loader=None, *args, **kwds):
         super().__init__(*args, **kwds)
 
         self.set_halign(Gtk.Align.CENTER)
         self.set_valign(Gtk.Align.CENTER)
 
         self.wallpaper_path = wp_path
+        self.thumbnail_loader = thumbnail_loader
+        self.thumbnail_task = None
+        self.has_thumb = False
         self.is_fav = False
         self.container_box = Gtk.Overlay()
         self.container_box.set_halign(Gtk.Align.CENTER)
@@ -50,15 +53,53 @@ class WallpaperBox(Gtk.FlowBoxChild):
 
         self.add(self.container_box)
 
-    def set_wallpaper_thumb(self):
-        pixbuf_fake_list=[]
-        pixbuf_thread = ThreadingHelper.do_async(
-            self.make_wallpaper_pixbuf,
-            (self.wallpaper_path, pixbuf_fake_list)
+        self.connect('destroy', self.on_destroy)
+
+    def set_wallpaper_thumb(self, priority=TaskScheduler.PRIORITY_DEFAULT):
+        if self.has_thumb or self.thumbnail_task:
+            return
+        if not self.thumbnail_loader:
+            self.on_wallpaper_pixbuf_ready(
+                self.make_wallpaper_pixbuf(self.wallpaper_path)
+            )
+            return
+        self.thumbnail_task = self.thumbnail_loader.request(
+            self.wallpaper_path,
+            self.on_wallpaper_pixbuf_ready,
+            priority
         )
-        ThreadingHelper.wait_for_thread(pixbuf_thread)
-        self.wp_image.set_from_pixbuf(pixbuf_fake_list[0])
+
+    def cancel_wallpaper_thumb(self):
+        if self.thumbnail_task:
+            self.thumbnail_task.cancel()
+            self.thumbnail_task = None
+
+    def unload_wallpaper_thumb(self):
+        self.cancel_wallpaper_thumb()
+        if self.has_thumb:
+            self.wp_image.set_from_icon_name('image-x-generic', Gtk.IconSize.DIALOG)
+            self.has_thumb = False
+
+    def on_destroy(self, *args):
+        # don't waste a worker on a thumbnail nobody will see
+        self.cancel_wallpaper_thumb()
+
+    def on_wallpaper_pixbuf_ready(self, pixbuf):
+        self.thumbnail_task = None
+        if not pixbuf:
+            # don't retry a broken image on every scroll
+            self.wp_image.set_from_icon_name('image-missing', Gtk.IconSize.DIALOG)
+            self.has_thumb = True
+            return
+        self.wp_image.set_from_pixbuf(pixbuf)
         self.wp_image.show()
+        self.has_thumb = True
+
+    def get_thumbnail_pixbuf(self):
+        # the decoded thumbnail, if any, for reuse (e.g. monitor previews)
+        if self.has_thumb and self.wp_image.get_storage_type() == Gtk.ImageType.PIXBUF:
+            return self.wp_image.get_pixbuf()
+        return None
 
     def set_fav(self, fav):
         self.is_fav = fav
@@ -1,14 +1,343 @@
+import os
+import inspect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from gi.repository import Gio
 from PIL import Image
 from PIL.ImageOps import fit
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import profiling as Profiling
 
 TMP_DIR='/tmp/HydraPaper/'
+TILE_CACHE_DEFAULT_MAX_SIZE_MB = 256
+
+# 'exact' fits every source with a full LANCZOS resample, 'fast' lets the
+# decoder and Pillow's reduce() do most of the downscaling of sources much
+# larger than their monitor
+MERGE_QUALITY_EXACT = 'exact'
+MERGE_QUALITY_FAST = 'fast'
+MERGE_QUALITIES = (MERGE_QUALITY_EXACT, MERGE_QUALITY_FAST)
+FAST_REDUCING_GAP = 2.0
+# resize(reducing_gap=...) needs Pillow >= 7.0, the flatpak builds 5.0:
+# older versions only get the jpeg draft() part of 'fast'
+RESIZE_HAS_REDUCING_GAP = (
+    'reducing_gap' in inspect.signature(Image.Image.resize).parameters
+)
+
+# 'auto' picks the cheapest format that doesn't visibly lose quality.
+# webp wallpapers need the webp gdk-pixbuf loader on the desktop side.
+OUTPUT_FORMAT_PNG = 'png'
+OUTPUT_FORMAT_JPEG = 'jpeg'
+OUTPUT_FORMAT_WEBP = 'webp'
+OUTPUT_FORMAT_AUTO = 'auto'
+OUTPUT_FORMATS = (
+    OUTPUT_FORMAT_PNG, OUTPUT_FORMAT_JPEG, OUTPUT_FORMAT_WEBP, OUTPUT_FORMAT_AUTO
+)
+OUTPUT_EXTENSIONS = {
+    OUTPUT_FORMAT_PNG: 'png',
+    OUTPUT_FORMAT_JPEG: 'jpg',
+    OUTPUT_FORMAT_WEBP: 'webp'
+}
+# zlib level 1 encodes several times faster than Pillow's default of 6,
+# for a slightly larger file
+DEFAULT_PNG_COMPRESS_LEVEL = 1
+PNG_COMPRESS_LEVELS = range(10)
+JPEG_QUALITY = 95
+WEBP_QUALITY = 95
+
+# 'numpy' composites into a preallocated RGBX array, which Pillow maps
+# without copying it, and can even out the colors of the monitors.
+# Encoders that don't take RGBX (png) need an RGB copy of the canvas,
+# making the merge peak higher than with 'pillow'.
+# numpy is an optional dependency, without it merges fall back to
+# 'pillow'.
+MERGE_BACKEND_PILLOW = 'pillow'
+MERGE_BACKEND_NUMPY = 'numpy'
+MERGE_BACKENDS = (MERGE_BACKEND_PILLOW, MERGE_BACKEND_NUMPY)
+# color matching gains are clamped, so that a night shot next to a
+# bright one doesn't get washed out
+COLOR_MATCH_MAX_GAIN = 1.25
+COLOR_MATCH_SAMPLE_STEP = 8
+# the output formats whose encoder takes the numpy canvas as it is
+RGBX_OUTPUT_FORMATS = (OUTPUT_FORMAT_JPEG, OUTPUT_FORMAT_WEBP)
+
+
+class MergeCancelled(Exception):
+    pass
+
+
+class TileCache:
+    '''
+    In-memory LRU cache of the per-monitor tiles fitted by
+    multi_setup_pillow, keyed by the source identity (path, mtime and
+    size), the target resolution and the resample filter, so that an
+    apply only re-fits the monitors whose wallpaper changed.
+    '''
+
+    def __init__(self, max_size_mb=TILE_CACHE_DEFAULT_MAX_SIZE_MB):
+        self.max_size = max_size_mb * 1024 * 1024
+        self.size = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_key(self, wp_path, resolution, method, quality=MERGE_QUALITY_EXACT):
+        wp_stat = os.stat(wp_path)
+        return (
+            wp_path, wp_stat.st_mtime_ns, wp_stat.st_size,
+            resolution, method, quality
+        )
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        tile_size = get_image_size_in_bytes(tile)
+        if tile_size > self.max_size:
+            return
+        with self.lock:
+            if key in self.tiles:
+                self.size -= get_image_size_in_bytes(self.tiles.pop(key))
+            self.tiles[key] = tile
+            self.size += tile_size
+            while self.size > self.max_size:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= get_image_size_in_bytes(evicted)
+
+
+def get_image_size_in_bytes(image):
+    # as stored by Pillow: multi band 8 bit images (e.g. RGB) take 4
+    # bytes per pixel
+    if len(image.getbands()) > 1 or image.mode in ('I', 'F'):
+        bytes_per_pixel = 4
+    elif image.mode.startswith('I;16'):
+        bytes_per_pixel = 2
+    else:
+        bytes_per_pixel = 1
+    return image.width * image.height * bytes_per_pixel
+
+
+def get_fit_box(image_size, size):
+    '''
+    Returns the centered crop box of an image of image_size that has the
+    aspect ratio of size, same as PIL.ImageOps.fit
+    '''
+    image_width, image_height = image_size
+    target_ratio = size[0] / size[1]
+    if image_width / image_height > target_ratio:
+        crop_width = image_height * target_ratio
+        crop_height = image_height
+    else:
+        crop_width = image_width
+        crop_height = image_width / target_ratio
+    left = (image_width - crop_width) / 2
+    top = (image_height - crop_height) / 2
+    return (left, top, left + crop_width, top + crop_height)
+
+
+def fast_fit(image, size, method=Image.LANCZOS):
+    box = get_fit_box(image.size, size)
+    # how much larger than the target the cropped source is
+    factor = min((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1])
+    if factor > 1 and image.format == 'JPEG':
+        # DCT scaling: the jpeg decoder only produces a 1/2, 1/4 or 1/8
+        # scaled image, still at least as large as needed
+        image.draft('RGB', (
+            int(image.width / factor) + 1,
+            int(image.height / factor) + 1
+        ))
+        box = get_fit_box(image.size, size)
+    with Profiling.span('decode', size=image.size):
+        image.load()
+    with Profiling.span('resize'):
+        if not RESIZE_HAS_REDUCING_GAP:
+            return image.resize(size, method, box=box)
+        return image.resize(size, method, box=box, reducing_gap=FAST_REDUCING_GAP)
+
+
+def fit_image(image, size, method=Image.LANCZOS, quality=MERGE_QUALITY_EXACT):
+    if quality == MERGE_QUALITY_FAST:
+        return fast_fit(image, size, method=method)
+    with Profiling.span('decode', size=image.size):
+        image.load()
+    with Profiling.span('fit'):
+        return fit(image, size, method=method)
+
+
+def fit_monitor_tile(monitor, tile_cache=None, method=Image.LANCZOS,
+                     quality=MERGE_QUALITY_EXACT):
+    resolution = (monitor.width * monitor.scaling, monitor.height * monitor.scaling)
+    if tile_cache:
+        key = tile_cache.get_key(monitor.wallpaper, resolution, method, quality)
+        tile = tile_cache.get(key)
+        if tile is not None:
+            return tile
+    with Profiling.span('fit monitor tile', monitor=monitor.name), \
+            Image.open(monitor.wallpaper) as image:
+        tile = fit_image(image, resolution, method, quality)
+    if tile_cache:
+        tile_cache.put(key, tile)
+    return tile
 
-def multi_setup_pillow(monitors, save_path, wp_setter_func=None):
-    images = list(map(Image.open, [m.wallpaper for m in monitors]))
-    resolutions = [(m.width * m.scaling, m.height * m.scaling) for m in monitors]
+
+def is_webp_supported():
+    # Pillow may be built without libwebp. Image.SAVE is only filled
+    # once the plugins are loaded
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def resolve_output_format(output_format, monitors):
+    if output_format == OUTPUT_FORMAT_WEBP and not is_webp_supported():
+        print('Error: Pillow was built without WebP support, saving as png instead')
+        return OUTPUT_FORMAT_PNG
+    if output_format != OUTPUT_FORMAT_AUTO:
+        return output_format
+    # sources that are all jpegs already went through lossy compression,
+    # a high quality jpeg encode keeps what's left and is much cheaper
+    # than png. Anything else might have sharp edges or gradients that
+    # jpeg would smear, so it gets a fast lossless png.
+    if all(
+            os.path.splitext(m.wallpaper)[1].lower() in ('.jpg', '.jpeg')
+            for m in monitors
+    ):
+        return OUTPUT_FORMAT_JPEG
+    return OUTPUT_FORMAT_PNG
+
+
+def save_merged_image(image, save_path, output_format=OUTPUT_FORMAT_PNG,
+                      png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL):
+    if output_format == OUTPUT_FORMAT_JPEG:
+        # no chroma subsampling, it's visible on text and thin lines
+        image.save(save_path, 'JPEG', quality=JPEG_QUALITY, subsampling=0)
+    elif output_format == OUTPUT_FORMAT_WEBP:
+        # method trades encode speed for size, 0 is the fastest
+        image.save(save_path, 'WEBP', quality=WEBP_QUALITY, method=0)
+    else:
+        image.save(save_path, 'PNG', compress_level=png_compress_level)
+
+
+def get_merge_backend(backend):
+    if backend == MERGE_BACKEND_NUMPY and numpy is None:
+        print('Error: numpy is not installed, merging with Pillow instead')
+        return MERGE_BACKEND_PILLOW
+    return backend
+
+
+def paste_tile_numpy(canvas, tile, offset):
+    if tile.mode != 'RGB':
+        tile = tile.convert('RGB')
+    x, y = offset
+    # Pillow doesn't expose its buffer, so each tile goes through one
+    # temporary tile sized copy before landing in its rows of the canvas
+    canvas[y:y + tile.height, x:x + tile.width, :3] = numpy.asarray(tile)
+
+
+def match_colors_numpy(canvas, monitors):
+    '''
+    Scales every channel of each monitor's region of canvas, in place,
+    so that its mean color moves to the mean of all the monitors,
+    evening out brightness and tint across different wallpapers.
+    '''
+    regions = [
+        canvas[
+            m.offset_y:m.offset_y + m.height * m.scaling,
+            m.offset_x:m.offset_x + m.width * m.scaling
+        ] for m in monitors
+    ]
+    # a sparse sample is plenty for a mean
+    means = numpy.array([
+        r[::COLOR_MATCH_SAMPLE_STEP, ::COLOR_MATCH_SAMPLE_STEP].mean(axis=(0, 1))
+        for r in regions
+    ])
+    gains = numpy.clip(
+        means.mean(axis=0) / numpy.maximum(means, 1),
+        1 / COLOR_MATCH_MAX_GAIN,
+        COLOR_MATCH_MAX_GAIN
+    )
+    levels = numpy.arange(256, dtype=numpy.float32)
+    for region, gain in zip(regions, gains):
+        for channel in range(3):
+            if abs(gain[channel] - 1) < 0.01:
+                continue
+            # a 256 entries lookup table avoids a float copy of the region
+            lut = numpy.clip(
+                levels * gain[channel] + 0.5, 0, 255
+            ).astype(numpy.uint8)
+            region[..., channel] = lut[region[..., channel]]
+
+
+def paste_tiles_low_memory(monitors, paste_tile, canvas_size,
+                           quality=MERGE_QUALITY_EXACT, check_cancelled=None):
+    '''
+    Fits and pastes one monitor at a time with paste_tile(tile, offset),
+    releasing each decoded source and fitted tile before moving on to
+    the next one. check_cancelled is called before every monitor.
+    Returns an estimate of the peak size of the image buffers held at
+    once, in bytes: the canvas, a decoded source and its fitted tile.
+    It's a lower bound, the intermediates of draft(), reduce() and the
+    crop inside fit_image aren't counted.
+    '''
+    peak_image_size = canvas_size
+    for m in monitors:
+        if check_cancelled:
+            check_cancelled()
+        resolution = (m.width * m.scaling, m.height * m.scaling)
+        with Profiling.span('fit monitor tile', monitor=m.name), \
+                Image.open(m.wallpaper) as image:
+            tile = fit_image(image, resolution, quality=quality)
+            # the size after a possible draft() is the decoded size
+            peak_image_size = max(
+                peak_image_size,
+                canvas_size + get_image_size_in_bytes(image) +
+                get_image_size_in_bytes(tile)
+            )
+        with Profiling.span('paste'):
+            paste_tile(tile, (m.offset_x, m.offset_y))
+        del tile
+    return peak_image_size
+
+
+def multi_setup_pillow(monitors, save_path, wp_setter_func=None, tile_cache=None,
+                       quality=MERGE_QUALITY_EXACT,
+                       output_format=OUTPUT_FORMAT_PNG,
+                       png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+                       low_memory=False, is_cancelled=None,
+                       backend=MERGE_BACKEND_PILLOW, match_colors=False):
+    '''
+    Merges the wallpapers of monitors into a single spanned image saved
+    to save_path, compositing with backend (see MERGE_BACKENDS).
+    match_colors evens out the colors of the monitors, only supported
+    by the numpy backend.
+    is_cancelled, if given, is checked before every tile and before
+    encoding: once it returns True the merge stops raising
+    MergeCancelled, nothing gets saved.
+    With low_memory the monitors are processed one after the other and
+    nothing is kept around (tile_cache is not used), so that only the
+    canvas and a single source are in memory at any given time.
+    Returns a dict with peak_image_size, a lower bound estimate of the
+    image buffers held at once by the merge (see paste_tiles_low_memory),
+    only measured with low_memory, None otherwise. The process RSS isn't
+    reported, it covers everything else the process did too.
+    '''
     offsets = [(m.offset_x, m.offset_y) for m in monitors]
 
+    def check_cancelled():
+        if is_cancelled and is_cancelled():
+            raise MergeCancelled()
+
+    def fit_tile(m):
+        check_cancelled()
+        return fit_monitor_tile(m, tile_cache, quality=quality)
+
     # DEBUG
     # for m in monitors:
     #     print(m)
@@ -19,13 +348,70 @@ def multi_setup_pillow(monitors, save_path, wp_setter_func=None):
     # DEBUG
     # print('Final Size: {} x {}'.format(final_image_width, final_image_height))
 
-    n_images = []
-    for i, r in zip(images, resolutions):
-        n_images.append(fit(i, r, method=Image.LANCZOS))
-    final_image = Image.new('RGB', (final_image_width, final_image_height))
-    for i, o in zip(n_images, offsets):
-        final_image.paste(i, o)
-    final_image.save(save_path)
+    backend = get_merge_backend(backend)
+    output_format = resolve_output_format(output_format, monitors)
+    peak_image_size = None
+    with Profiling.span('allocate canvas', backend=backend):
+        if backend == MERGE_BACKEND_NUMPY:
+            # same layout as Pillow's own RGB storage, so that it can be
+            # mapped. Zeroed pages only get committed as tiles are written
+            canvas = numpy.zeros(
+                (final_image_height, final_image_width, 4), numpy.uint8
+            )
+            paste_tile = lambda tile, offset: paste_tile_numpy(canvas, tile, offset)
+            canvas_size = canvas.nbytes
+        else:
+            final_image = Image.new('RGB', (final_image_width, final_image_height))
+            paste_tile = final_image.paste
+            canvas_size = get_image_size_in_bytes(final_image)
+    if low_memory:
+        peak_image_size = paste_tiles_low_memory(
+            monitors, paste_tile, canvas_size, quality, check_cancelled
+        )
+    else:
+        # decoding and resampling release the GIL, so the monitors are fitted
+        # in parallel and the merge takes as long as the slowest of them
+        with Profiling.span('fit tiles'), ThreadPoolExecutor(
+                max_workers=min(len(monitors), os.cpu_count() or 1),
+                thread_name_prefix='HydraPaperMerger'
+        ) as executor:
+            n_images = list(executor.map(fit_tile, monitors))
+        with Profiling.span('paste'):
+            for i, o in zip(n_images, offsets):
+                paste_tile(i, o)
+        del n_images
+    if backend == MERGE_BACKEND_NUMPY:
+        if match_colors:
+            check_cancelled()
+            with Profiling.span('match colors'):
+                match_colors_numpy(canvas[..., :3], monitors)
+        # maps the array, no copy
+        final_image = Image.frombuffer(
+            'RGBX', (final_image_width, final_image_height), canvas,
+            'raw', 'RGBX', 0, 1
+        )
+        # the image keeps the array alive, the lambda holds it too
+        del canvas, paste_tile
+        if output_format not in RGBX_OUTPUT_FORMATS:
+            with Profiling.span('convert canvas'):
+                rgb_image = final_image.convert('RGB')
+            if peak_image_size is not None:
+                # both are held while converting
+                peak_image_size = max(
+                    peak_image_size,
+                    canvas_size + get_image_size_in_bytes(rgb_image)
+                )
+            final_image.close()
+            final_image = rgb_image
+    check_cancelled()
+    with Profiling.span('encode', format=output_format):
+        save_merged_image(
+            final_image, save_path, output_format, png_compress_level
+        )
+    final_image.close()
+    return {
+        'peak_image_size': peak_image_size
+    }
 
 def set_wallpaper_gnome(path, wp_mode='spanned'):
     gsettings = Gio.Settings.new('org.gnome.desktop.background')
@@ -40,3 +426,130 @@ def set_wallpaper_mate(path, wp_mode='spanned'):
     mode_key = 'picture-options'
     gsettings.set_string(wp_key, path)
     gsettings.set_string(mode_key, wp_mode)
+
+def get_schema_settings(schema_id):
+    # Gio.Settings.new aborts the process if the schema isn't installed
+    schema_source = Gio.SettingsSchemaSource.get_default()
+    if not schema_source or not schema_source.lookup(schema_id, True):
+        return None
+    return Gio.Settings.new(schema_id)
+
+def get_current_wallpapers():
+    '''
+    Returns the paths of the wallpapers currently set on the desktop.
+    '''
+    paths = []
+    if os.environ.get('XDG_CURRENT_DESKTOP') == 'MATE':
+        gsettings = get_schema_settings('org.mate.background')
+        if gsettings:
+            paths.append(gsettings.get_string('picture-filename'))
+        return [p for p in paths if p]
+    gsettings = get_schema_settings('org.gnome.desktop.background')
+    if gsettings:
+        for wp_key in ('picture-uri', 'picture-uri-dark'):
+            if gsettings.props.settings_schema.has_key(wp_key):
+                uri = gsettings.get_string(wp_key)
+                if uri:
+                    paths.append(Gio.File.new_for_uri(uri).get_path())
+    return [p for p in paths if p]
+
+def get_wallpaper_setter():
+    if os.environ.get('XDG_CURRENT_DESKTOP') == 'MATE':
+        return set_wallpaper_mate
+    return set_wallpaper_gnome
+
+def merge_wallpapers_cached(monitors, merge_cache, configuration, tile_cache=None,
+                            is_cancelled=None):
+    '''
+    Returns the path of the merged wallpaper for monitors, merging them
+    with the options in configuration only if merge_cache doesn't
+    already have it. Merges are serialized, so if the same merge is
+    already running (e.g. pre-rendered) this waits for it and gets a
+    cache hit. Raises MergeCancelled if is_cancelled returns True
+    before the merge is done, see multi_setup_pillow.
+    '''
+    merge_quality = configuration['merge_quality']
+    output_format = resolve_output_format(
+        configuration['merge_output_format'],
+        monitors
+    )
+    png_compress_level = configuration['merge_png_compress_level']
+    output_extension = OUTPUT_EXTENSIONS[output_format]
+    backend = get_merge_backend(configuration['merge_backend'])
+    match_colors = (
+        configuration['merge_match_colors'] and
+        backend == MERGE_BACKEND_NUMPY
+    )
+    merge_options = [merge_quality, output_format, png_compress_level]
+    # both backends produce the same image unless colors are matched,
+    # and existing cache entries stay valid
+    if match_colors:
+        merge_options.append('match colors')
+    merge_key = merge_cache.get_key(monitors, *merge_options)
+    with Profiling.span('merge cache lookup'):
+        saved_wp_path = merge_cache.lookup(merge_key)
+    if not saved_wp_path:
+        with Profiling.span('wait for running merge'):
+            merge_cache.merge_lock.acquire()
+        try:
+            # it may have been merged while waiting, the miss is counted
+            saved_wp_path = merge_cache.lookup(merge_key, count=False)
+            if not saved_wp_path:
+                tmp_wp_path = merge_cache.get_temp_path(merge_key, output_extension)
+                with Profiling.span('merge', monitors=len(monitors)):
+                    try:
+                        merge_stats = multi_setup_pillow(
+                            monitors,
+                            tmp_wp_path,
+                            tile_cache=tile_cache,
+                            quality=merge_quality,
+                            output_format=output_format,
+                            png_compress_level=png_compress_level,
+                            low_memory=configuration['merge_low_memory'],
+                            is_cancelled=is_cancelled,
+                            backend=backend,
+                            match_colors=match_colors
+                        )
+                    except BaseException:
+                        # e.g. MergeCancelled
+                        merge_cache.discard_temp(tmp_wp_path)
+                        raise
+                if merge_stats['peak_image_size'] is not None:
+                    print('Merge peak memory: at least {0:.1f} MB of image buffers'.format(
+                        merge_stats['peak_image_size'] / 1024 / 1024
+                    ))
+                with Profiling.span('merge cache store'):
+                    saved_wp_path = merge_cache.store(
+                        merge_key, tmp_wp_path, output_extension
+                    )
+        finally:
+            merge_cache.merge_lock.release()
+    else:
+        print(
+            'Hit cache for wallpaper {0}. Skipping merge operation.'.format(
+                saved_wp_path
+            )
+        )
+    print('Merge cache: {hits} hits, {misses} misses, {entries} entries ({size} bytes)'.format(
+        **merge_cache.get_stats()
+    ))
+    return saved_wp_path
+
+def apply_wallpapers(monitors, merge_cache, configuration, tile_cache=None):
+    '''
+    Sets the wallpapers of monitors on the current desktop and returns
+    the path of the image set. Doesn't need Gtk, used by the UI, the
+    command line and the service.
+    '''
+    wp_setter_func = get_wallpaper_setter()
+    with Profiling.operation('apply', monitors=len(monitors)):
+        if len(monitors) == 1:
+            with Profiling.span('set wallpaper'):
+                wp_setter_func(monitors[0].wallpaper, 'zoom')
+            return monitors[0].wallpaper
+        saved_wp_path = merge_wallpapers_cached(
+            monitors, merge_cache, configuration, tile_cache
+        )
+        with Profiling.span('set wallpaper'):
+            wp_setter_func(saved_wp_path)
+        return saved_wp_path
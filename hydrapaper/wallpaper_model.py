@@ -0,0 +1,123 @@
+import bisect
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GObject, Gio
+
+
+class WallpaperItem(GObject.Object):
+    '''
+    A wallpaper in the library, the model items the flowboxes are bound to.
+    '''
+
+    def __init__(self, wallpaper_path):
+        super().__init__()
+        self.wallpaper_path = wallpaper_path
+        # set by the WallpaperVisibilityIndex
+        self.wallpaper_folder = None
+
+
+class WallpaperFilterModel(GObject.Object, Gio.ListModel):
+    '''
+    Gio.ListModel exposing the items of a source Gio.ListStore for which
+    filter_func(item) is true, in the source order. Gtk 3 has no filter
+    list model, so this keeps a sorted list of the source positions of
+    the visible items, which makes appending to the source (the common
+    case while scanning) and re-evaluating single items cheap.
+    '''
+
+    def __init__(self, source, filter_func):
+        super().__init__()
+        self.source = source
+        self.filter_func = filter_func
+        self.source_items = []
+        self.visible_positions = []
+        # item -> source position, rebuilt lazily after removals
+        self.source_index = {}
+        self.source_index_valid = True
+        self.source.connect('items-changed', self.on_source_items_changed)
+        self.on_source_items_changed(self.source, 0, 0, self.source.get_n_items())
+
+    def do_get_item_type(self):
+        return WallpaperItem.__gtype__
+
+    def do_get_n_items(self):
+        return len(self.visible_positions)
+
+    def do_get_item(self, position):
+        if position >= len(self.visible_positions):
+            return None
+        return self.source_items[self.visible_positions[position]]
+
+    def on_source_items_changed(self, source, position, removed, added):
+        new_items = [source.get_item(position + i) for i in range(added)]
+        if removed == 0 and position == len(self.source_items):
+            for i, item in enumerate(new_items):
+                self.source_index[item] = position + i
+        else:
+            self.source_index_valid = False
+        self.source_items[position:position + removed] = new_items
+        start = bisect.bisect_left(self.visible_positions, position)
+        end = bisect.bisect_left(self.visible_positions, position + removed)
+        shift = added - removed
+        tail = self.visible_positions[end:]
+        if shift:
+            tail = [p + shift for p in tail]
+        inserted = [
+            position + i for i, item in enumerate(new_items)
+            if self.filter_func(item)
+        ]
+        self.visible_positions[start:] = inserted + tail
+        if end - start or inserted:
+            self.items_changed(start, end - start, len(inserted))
+
+    def get_source_position(self, item):
+        '''
+        Returns the position of item in the source, or None.
+        '''
+        if not self.source_index_valid:
+            self.source_index = {
+                item: i for i, item in enumerate(self.source_items)
+            }
+            self.source_index_valid = True
+        return self.source_index.get(item)
+
+    def get_position(self, item):
+        '''
+        Returns the position of item in this model, or None if filtered out.
+        '''
+        source_position = self.get_source_position(item)
+        if source_position is None:
+            return None
+        position = bisect.bisect_left(self.visible_positions, source_position)
+        if (
+                position < len(self.visible_positions) and
+                self.visible_positions[position] == source_position
+        ):
+            return position
+        return None
+
+    def refilter(self, items, rebuild=False):
+        '''
+        Re-evaluates the filter for items only. With rebuild, items that
+        stay visible are reported as changed too, so that their widgets
+        get recreated.
+        '''
+        for item in items:
+            source_position = self.get_source_position(item)
+            if source_position is None:
+                continue
+            position = bisect.bisect_left(self.visible_positions, source_position)
+            was_visible = (
+                position < len(self.visible_positions) and
+                self.visible_positions[position] == source_position
+            )
+            is_visible = self.filter_func(item)
+            if was_visible and not is_visible:
+                del self.visible_positions[position]
+                self.items_changed(position, 1, 0)
+            elif is_visible and not was_visible:
+                self.visible_positions.insert(position, source_position)
+                self.items_changed(position, 0, 1)
+            elif is_visible and rebuild:
+                self.items_changed(position, 1, 1)
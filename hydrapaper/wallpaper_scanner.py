@@ -0,0 +1,65 @@
+import os
+
+IMAGE_EXTENSIONS = {
+    '.jpg',
+    '.jpeg',
+    '.png',
+    '.tiff',
+    '.svg'
+}
+DEFAULT_BATCH_SIZE = 500
+
+
+def is_image_filename(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def scan_folder(folder, recursive=False):
+    '''
+    Yields the path of every image in folder, and in its subfolders if
+    recursive (symlinked subfolders are not followed, to avoid loops).
+    Uses the file type cached in the os.scandir entries, so on most
+    filesystems no file gets stat'ed.
+    '''
+    pending_dirs = [folder]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            it = os.scandir(current_dir)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        if is_image_filename(entry.name):
+                            # same format as the paths saved in the favorites
+                            yield '{0}/{1}'.format(current_dir, entry.name)
+                    elif recursive and entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append('{0}/{1}'.format(current_dir, entry.name))
+                except OSError:
+                    continue
+
+
+def scan_folders(folders, recursive=False, batch_callback=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Scans every folder in folders. If batch_callback is given, it is
+    called with lists of up to batch_size new paths as soon as they are
+    found, and the paths that didn't fill a whole batch are returned.
+    Otherwise every path found is returned.
+    '''
+    seen = set()
+    batch = []
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for wp_path in scan_folder(folder, recursive):
+            if wp_path in seen:
+                continue
+            seen.add(wp_path)
+            batch.append(wp_path)
+            if batch_callback and len(batch) >= batch_size:
+                batch_callback(batch)
+                batch = []
+    return batch
@@ -0,0 +1,66 @@
+class WallpaperVisibilityIndex:
+    '''
+    Indexes the wallpaper model items by folder and by path, along with
+    the active state of every folder and the set of favorites, so that
+    the visibility of an item in either view is computed in constant
+    time and a folder or favorite toggle only needs to re-evaluate the
+    items it affects.
+    '''
+
+    def __init__(self, configuration, favorites):
+        self.configuration = configuration
+        self.favorites = favorites
+        self.items_by_folder = {}
+        self.items_by_path = {}
+        self.clear()
+
+    def clear(self):
+        # the folders only change along with a full refresh, which
+        # clears the index first
+        self.items_by_folder = {}
+        self.items_by_path = {}
+        self.folders_active = {
+            folder['path']: folder['active']
+            for folder in self.configuration['wallpapers_paths']
+        }
+
+    def get_folder(self, wp_path):
+        for folder in self.configuration['wallpapers_paths']:
+            if folder['path'] in wp_path:
+                return folder['path']
+        return None
+
+    def add(self, item):
+        item.wallpaper_folder = self.get_folder(item.wallpaper_path)
+        self.items_by_folder.setdefault(item.wallpaper_folder, set()).add(item)
+        self.items_by_path[item.wallpaper_path] = item
+
+    def remove(self, item):
+        self.items_by_folder.get(item.wallpaper_folder, set()).discard(item)
+        self.items_by_path.pop(item.wallpaper_path, None)
+
+    def get_item(self, wp_path):
+        return self.items_by_path.get(wp_path)
+
+    def get_folder_items(self, folder):
+        return list(self.items_by_folder.get(folder, ()))
+
+    def get_favorites_items(self):
+        return [
+            self.items_by_path[wp_path] for wp_path in self.favorites
+            if wp_path in self.items_by_path
+        ]
+
+    def set_folder_active(self, folder, active):
+        self.folders_active[folder] = active
+
+    def is_favorite(self, wp_path):
+        return wp_path in self.favorites
+
+    def is_visible(self, item, favorites_view):
+        if not self.folders_active.get(item.wallpaper_folder):
+            return False
+        is_fav = item.wallpaper_path in self.favorites
+        if favorites_view:
+            return is_fav
+        return not is_fav or self.configuration['favorites_in_mainview']
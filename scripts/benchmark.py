@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# Benchmarks the merge, scan and thumbnail hot paths on synthetic
+# libraries and monitor layouts. Needs no display. Every case runs in
+# its own fresh process so that its peak RSS is its own; results are
+# printed (or written with --output) as JSON.
+#
+#   scripts/benchmark.py
+#   scripts/benchmark.py --quick --benchmarks merge --output before.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import queue
+import tempfile
+import argparse
+import multiprocessing
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, REPO_ROOT)
+
+BENCHMARKS = ('merge', 'scan', 'thumbnails')
+MONITOR_COUNTS = (1, 2, 3, 4, 6)
+QUICK_MONITOR_COUNTS = (1, 2, 3)
+LIBRARY_SIZES = (1000, 10000, 50000)
+QUICK_LIBRARY_SIZES = (1000,)
+# the scan doesn't open files, these only need the right extensions
+SCAN_EXTENSIONS = ('jpg', 'png', 'svg')
+FILES_PER_DIRECTORY = 500
+THUMBNAIL_SOURCES = 24
+QUICK_THUMBNAIL_SOURCES = 6
+SOURCE_SIZE = (3840, 2160)
+# a run taking longer than this is reported as an error
+CASE_TIMEOUT_S = 600
+
+SVG_TEMPLATE = '''<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}">
+  <defs>
+    <linearGradient id="g" x1="0" y1="0" x2="1" y2="1">
+      <stop offset="0" stop-color="#{c1:06x}"/>
+      <stop offset="1" stop-color="#{c2:06x}"/>
+    </linearGradient>
+  </defs>
+  <rect width="{w}" height="{h}" fill="url(#g)"/>
+  <circle cx="{cx}" cy="{cy}" r="{r}" fill="#{c1:06x}" opacity="0.5"/>
+</svg>
+'''
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_source_image(path, size, seed):
+    from PIL import Image, ImageDraw
+    # a gradient with some shapes, so that it doesn't compress to nothing
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for i in range(32):
+        x = (seed * 7919 + i * 104729) % size[0]
+        y = (seed * 104729 + i * 7919) % size[1]
+        draw.ellipse(
+            (x, y, x + size[0] // 8, y + size[1] // 8),
+            fill=((seed * 37 + i * 11) % 256, (i * 53) % 256, (seed * 91) % 256)
+        )
+    if path.endswith('.png'):
+        image.save(path, compress_level=1)
+    else:
+        image.save(path, quality=90)
+    image.close()
+
+
+def make_svg_image(path, size, seed):
+    with open(path, 'w') as fd:
+        fd.write(SVG_TEMPLATE.format(
+            w=size[0], h=size[1],
+            c1=(seed * 2654435761) & 0xffffff, c2=(seed * 40503) & 0xffffff,
+            cx=size[0] // 2, cy=size[1] // 2, r=min(size) // 3
+        ))
+
+
+def make_layout(n_monitors, mixed_scaling):
+    # monitors side by side, every other one at scaling 2 if mixed
+    from hydrapaper import monitor_parser as MonitorParser
+    monitors = []
+    offset_x = 0
+    for i in range(n_monitors):
+        scaling = 2 if mixed_scaling and i % 2 else 1
+        width, height = (1920, 1080) if scaling == 1 else (1280, 720)
+        monitors.append(MonitorParser.Monitor(
+            width, height, scaling, offset_x, 0, i, 'Monitor {0}'.format(i)
+        ))
+        offset_x += width * scaling
+    return monitors
+
+
+def bench_merge(workdir, n_monitors, mixed_scaling, source_format, quality,
+                output_format, low_memory, backend, match_colors):
+    from hydrapaper import wallpaper_merger as WallpaperMerger
+    if backend == WallpaperMerger.MERGE_BACKEND_NUMPY and WallpaperMerger.numpy is None:
+        # rather than silently measuring the Pillow fallback
+        raise ImportError('numpy is not installed')
+    monitors = make_layout(n_monitors, mixed_scaling)
+    for m in monitors:
+        m.wallpaper = '{0}/source_{1}.{2}'.format(workdir, m.index, source_format)
+    save_path = '{0}/merged.{1}'.format(
+        workdir, WallpaperMerger.OUTPUT_EXTENSIONS.get(output_format, 'png')
+    )
+    start = time.perf_counter()
+    WallpaperMerger.multi_setup_pillow(
+        monitors, save_path,
+        quality=quality,
+        output_format=output_format,
+        low_memory=low_memory,
+        backend=backend,
+        match_colors=match_colors
+    )
+    wall_time = time.perf_counter() - start
+    megapixels = sum(
+        m.width * m.scaling * m.height * m.scaling for m in monitors
+    ) / 1000000
+    return wall_time, megapixels / wall_time, 'output megapixels/s'
+
+
+def bench_scan(workdir, n_files, warm_index):
+    from hydrapaper import wallpaper_scanner as WallpaperScanner
+    library = '{0}/library_{1}'.format(workdir, n_files)
+    if warm_index is None:
+        start = time.perf_counter()
+        found = len(WallpaperScanner.scan_folders([library], recursive=True))
+        wall_time = time.perf_counter() - start
+    else:
+        from hydrapaper import library_index as LibraryIndex
+        index_path = '{0}/index_{1}'.format(workdir, n_files)
+        shutil.rmtree(index_path, ignore_errors=True)
+        library_index = LibraryIndex.LibraryIndex(index_path)
+        if warm_index:
+            library_index.scan([library], recursive=True)
+        start = time.perf_counter()
+        found = len(library_index.scan([library], recursive=True))
+        wall_time = time.perf_counter() - start
+        library_index.close()
+    if found != n_files:
+        raise RuntimeError('scan found {0} files instead of {1}'.format(found, n_files))
+    return wall_time, n_files / wall_time, 'files/s'
+
+
+def bench_thumbnails(workdir, source_format, n_sources, warm_cache):
+    from hydrapaper import thumbnail_cache as ThumbnailCache
+    cache_path = '{0}/thumbnail_cache_{1}'.format(workdir, source_format)
+    shutil.rmtree(cache_path, ignore_errors=True)
+    thumbnail_cache = ThumbnailCache.ThumbnailCache(cache_path)
+    sources = [
+        '{0}/thumb_source_{1}.{2}'.format(workdir, i, source_format)
+        for i in range(n_sources)
+    ]
+    if warm_cache:
+        for wp_path in sources:
+            thumbnail_cache.get_pixbuf(wp_path)
+    start = time.perf_counter()
+    for wp_path in sources:
+        thumbnail_cache.get_pixbuf(wp_path)
+    wall_time = time.perf_counter() - start
+    return wall_time, n_sources / wall_time, 'thumbnails/s'
+
+
+BENCH_FUNCS = {
+    'merge': bench_merge,
+    'scan': bench_scan,
+    'thumbnails': bench_thumbnails,
+}
+
+
+def run_case_process(benchmark, workdir, params, result_queue):
+    try:
+        wall_time, throughput, unit = BENCH_FUNCS[benchmark](workdir, **params)
+        result_queue.put({
+            'wall_time_s': round(wall_time, 6),
+            'throughput': round(throughput, 3),
+            'throughput_unit': unit,
+            'peak_rss_mb': round(get_peak_rss_mb(), 1)
+        })
+    except Exception as e:
+        result_queue.put({'error': '{0}: {1}'.format(type(e).__name__, e)})
+
+
+def get_case_result(process, result_queue, timeout):
+    # polls, so that a child killed by a signal (e.g. the OOM killer or a
+    # segfault in Pillow) doesn't leave the harness waiting forever
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # it may have put its result right before exiting
+            try:
+                return result_queue.get(timeout=1)
+            except queue.Empty:
+                return {'error': 'process exited with code {0}'.format(process.exitcode)}
+        if time.monotonic() > deadline:
+            process.kill()
+            return {'error': 'timed out after {0}s'.format(timeout)}
+
+
+def run_case(benchmark, workdir, params, repeat, timeout=CASE_TIMEOUT_S):
+    # fresh interpreter per run, so that peak RSS isn't inherited
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for i in range(repeat):
+        result_queue = context.Queue()
+        process = context.Process(
+            target=run_case_process, args=(benchmark, workdir, params, result_queue)
+        )
+        process.start()
+        result = get_case_result(process, result_queue, timeout)
+        process.join()
+        if 'error' in result:
+            return dict(benchmark=benchmark, params=params, **result)
+        runs.append(result)
+    best = min(runs, key=lambda r: r['wall_time_s'])
+    return dict(
+        benchmark=benchmark,
+        params=params,
+        runs=len(runs),
+        wall_time_s=best['wall_time_s'],
+        wall_time_s_all=[r['wall_time_s'] for r in runs],
+        throughput=best['throughput'],
+        throughput_unit=best['throughput_unit'],
+        peak_rss_mb=max(r['peak_rss_mb'] for r in runs)
+    )
+
+
+def prepare_merge(workdir, max_monitors):
+    for i in range(max_monitors):
+        for source_format in ('jpg', 'png'):
+            make_source_image(
+                '{0}/source_{1}.{2}'.format(workdir, i, source_format),
+                SOURCE_SIZE, i
+            )
+
+
+def prepare_scan(workdir, library_sizes):
+    for n_files in library_sizes:
+        library = '{0}/library_{1}'.format(workdir, n_files)
+        for i in range(n_files):
+            directory = '{0}/d{1}'.format(library, i // FILES_PER_DIRECTORY)
+            if i % FILES_PER_DIRECTORY == 0:
+                os.makedirs(directory, exist_ok=True)
+            open('{0}/wp{1}.{2}'.format(
+                directory, i, SCAN_EXTENSIONS[i % len(SCAN_EXTENSIONS)]
+            ), 'w').close()
+
+
+def prepare_thumbnails(workdir, n_sources):
+    for i in range(n_sources):
+        for source_format in ('jpg', 'png'):
+            make_source_image(
+                '{0}/thumb_source_{1}.{2}'.format(workdir, i, source_format),
+                SOURCE_SIZE, i
+            )
+        make_svg_image(
+            '{0}/thumb_source_{1}.svg'.format(workdir, i), SOURCE_SIZE, i
+        )
+
+
+def get_cases(benchmarks, quick):
+    cases = []
+    if 'merge' in benchmarks:
+        for n_monitors in (QUICK_MONITOR_COUNTS if quick else MONITOR_COUNTS):
+            for mixed_scaling in (False, True):
+                if mixed_scaling and n_monitors == 1:
+                    continue
+                # Pillow can't read SVG, the merge only gets raster sources
+                for source_format in ('jpg', 'png'):
+                    for quality in ('exact', 'fast'):
+                        for output_format, low_memory, backend, match_colors in (
+                                ('png', False, 'pillow', False),
+                                ('jpeg', False, 'pillow', False),
+                                ('png', True, 'pillow', False),
+                                ('png', False, 'numpy', False),
+                                ('jpeg', False, 'numpy', False),
+                                ('png', True, 'numpy', False),
+                                ('png', False, 'numpy', True)
+                        ):
+                            cases.append(('merge', {
+                                'n_monitors': n_monitors,
+                                'mixed_scaling': mixed_scaling,
+                                'source_format': source_format,
+                                'quality': quality,
+                                'output_format': output_format,
+                                'low_memory': low_memory,
+                                'backend': backend,
+                                'match_colors': match_colors
+                            }))
+    if 'scan' in benchmarks:
+        for n_files in (QUICK_LIBRARY_SIZES if quick else LIBRARY_SIZES):
+            # None is the plain scanner, without the library index
+            for warm_index in (None, False, True):
+                cases.append(('scan', {
+                    'n_files': n_files,
+                    'warm_index': warm_index
+                }))
+    if 'thumbnails' in benchmarks:
+        for source_format in ('jpg', 'png', 'svg'):
+            for warm_cache in (False, True):
+                cases.append(('thumbnails', {
+                    'source_format': source_format,
+                    'n_sources': QUICK_THUMBNAIL_SOURCES if quick else THUMBNAIL_SOURCES,
+                    'warm_cache': warm_cache
+                }))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the HydraPaper merge, scan and thumbnail paths'
+    )
+    parser.add_argument(
+        '--benchmarks', default=','.join(BENCHMARKS),
+        help='comma separated list out of {0}'.format(', '.join(BENCHMARKS))
+    )
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller cases')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest is reported')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--workdir', help='where to generate the synthetic data (default: a temporary directory)')
+    parser.add_argument(
+        '--timeout', type=float, default=CASE_TIMEOUT_S,
+        help='seconds after which a run is killed and reported as an error'
+    )
+    args = parser.parse_args()
+
+    benchmarks = [b for b in args.benchmarks.split(',') if b]
+    for b in benchmarks:
+        if b not in BENCHMARKS:
+            parser.error('unknown benchmark {0}'.format(b))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='hydrapaper-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        print('Generating synthetic data in {0}...'.format(workdir), file=sys.stderr)
+        if 'merge' in benchmarks:
+            prepare_merge(workdir, max(QUICK_MONITOR_COUNTS if args.quick else MONITOR_COUNTS))
+        if 'scan' in benchmarks:
+            prepare_scan(workdir, QUICK_LIBRARY_SIZES if args.quick else LIBRARY_SIZES)
+        if 'thumbnails' in benchmarks:
+            prepare_thumbnails(workdir, QUICK_THUMBNAIL_SOURCES if args.quick else THUMBNAIL_SOURCES)
+        results = []
+        for benchmark, params in get_cases(benchmarks, args.quick):
+            print('Running {0} {1}'.format(benchmark, params), file=sys.stderr)
+            results.append(run_case(benchmark, workdir, params, args.repeat, args.timeout))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results
+    }
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    from gi.repository import GLib
+    from hydrapaper import service as Service
+except ImportError:  # needs PyGObject and Pillow
+    Service = None
+
+LAYOUT = [
+    {
+        'width': 1920, 'height': 1080, 'scaling': 1,
+        'offset_x': 0, 'offset_y': 0,
+        'index': 0, 'name': 'DP-1', 'primary': True
+    },
+    {
+        'width': 1920, 'height': 1080, 'scaling': 1,
+        'offset_x': 1920, 'offset_y': 0,
+        'index': 1, 'name': 'DP-2', 'primary': False
+    }
+]
+
+
+class FakeInvocation:
+    '''
+    Stands in for the Gio.DBusMethodInvocation of a call on the session bus.
+    '''
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.returned = False
+
+    def return_value(self, value):
+        self.returned = True
+        self.value = value
+
+    def return_dbus_error(self, name, message):
+        self.returned = True
+        self.error = (name, message)
+
+
+class SyncTaskScheduler:
+    # runs tasks right away, instead of on a worker and back in the main loop
+
+    def submit(self, function, *args, callback=None, error_callback=None,
+               priority=None):
+        try:
+            result = function(*args)
+        except Exception as e:
+            error_callback(e)
+            return
+        callback(result)
+
+    def shutdown(self, wait=False):
+        pass
+
+
+@unittest.skipIf(Service is None, 'PyGObject or Pillow not available')
+class ServiceDispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration = {
+            'monitors_layout': [dict(m) for m in LAYOUT],
+            'monitors': {'DP-1': '/wp/a.jpg', 'DP-2': '/wp/b.jpg'},
+            'wallpapers_paths': [{'path': '/wp', 'active': True}],
+            'recursive_scan': False,
+            'thumbnail_cache_max_size_mb': 1,
+            'merge_cache_max_size_mb': 1,
+            'merge_cache_max_age_days': 1
+        }
+        config_store = mock.Mock()
+        config_store.load.return_value = self.configuration
+        config_store.reload.return_value = self.configuration
+        patches = [
+            mock.patch.object(
+                Service.ConfigStore, 'ConfigStore', return_value=config_store
+            ),
+            mock.patch.object(
+                Service.TaskScheduler, 'TaskScheduler', SyncTaskScheduler
+            ),
+            mock.patch.object(Service.ThumbnailCache, 'ThumbnailCache'),
+            mock.patch.object(Service.MergeCache, 'MergeCache'),
+            mock.patch.object(Service.WallpaperMerger, 'TileCache'),
+            mock.patch.object(Service.LibraryIndex, 'LibraryIndex'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.config_store = config_store
+        self.service = Service.Service()
+
+    def call(self, method_name, parameters=None):
+        invocation = FakeInvocation()
+        self.service.on_method_call(
+            None, ':1.42', Service.OBJECT_PATH, Service.INTERFACE_NAME,
+            method_name, parameters or GLib.Variant('()', ()), invocation
+        )
+        self.assertTrue(invocation.returned)
+        return invocation
+
+    def test_apply(self):
+        with mock.patch.object(
+                Service.WallpaperMerger, 'apply_wallpapers',
+                return_value='/cache/merged.png'
+        ) as apply_wallpapers:
+            invocation = self.call('Apply')
+        self.assertIsNone(invocation.error)
+        self.assertEqual(invocation.value.unpack(), ('/cache/merged.png',))
+        monitors = apply_wallpapers.call_args[0][0]
+        self.assertEqual(
+            [(m.name, m.wallpaper) for m in monitors],
+            [('DP-1', '/wp/a.jpg'), ('DP-2', '/wp/b.jpg')]
+        )
+
+    def test_apply_error(self):
+        with mock.patch.object(
+                Service.WallpaperMerger, 'apply_wallpapers',
+                side_effect=OSError('disk full')
+        ):
+            invocation = self.call('Apply')
+        self.assertEqual(invocation.error, (Service.ERROR_NAME, 'disk full'))
+
+    def test_apply_without_wallpaper(self):
+        del self.configuration['monitors']['DP-2']
+        with mock.patch.object(
+                Service.WallpaperMerger, 'apply_wallpapers'
+        ) as apply_wallpapers:
+            invocation = self.call('Apply')
+        apply_wallpapers.assert_not_called()
+        self.assertEqual(invocation.error[0], Service.ERROR_NAME)
+        self.assertIn('DP-2', invocation.error[1])
+
+    def make_file(self, name):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, name)
+        with open(path, 'wb') as fd:
+            fd.write(b'not decoded by the service')
+        return path
+
+    def test_set_monitor_wallpaper(self):
+        wp_path = self.make_file('c.jpg')
+        invocation = self.call(
+            'SetMonitorWallpaper',
+            GLib.Variant('(ss)', ('DP-2', wp_path))
+        )
+        self.assertIsNone(invocation.error)
+        self.assertIsNone(invocation.value)
+        self.assertEqual(self.configuration['monitors']['DP-2'], wp_path)
+        self.config_store.flush.assert_called_once_with()
+
+    def test_set_monitor_wallpaper_not_an_image(self):
+        for wp_path in ('/wp/missing.jpg', self.make_file('notes.txt')):
+            with self.subTest(wp_path=wp_path):
+                invocation = self.call(
+                    'SetMonitorWallpaper',
+                    GLib.Variant('(ss)', ('DP-2', wp_path))
+                )
+                self.assertEqual(invocation.error[0], Service.ERROR_NAME)
+        self.assertEqual(self.configuration['monitors']['DP-2'], '/wp/b.jpg')
+        self.config_store.flush.assert_not_called()
+
+    def test_set_monitor_wallpaper_unknown_monitor(self):
+        invocation = self.call(
+            'SetMonitorWallpaper',
+            GLib.Variant('(ss)', ('HDMI-9', '/wp/c.jpg'))
+        )
+        self.assertEqual(invocation.error[0], Service.ERROR_NAME)
+        self.assertNotIn('HDMI-9', self.configuration['monitors'])
+        self.config_store.flush.assert_not_called()
+
+    def test_list_library(self):
+        self.service.library_index.scan.return_value = ['/wp/a.jpg', '/wp/b.jpg']
+        invocation = self.call('ListLibrary')
+        self.assertEqual(
+            invocation.value.unpack(), (['/wp/a.jpg', '/wp/b.jpg'],)
+        )
+        self.service.library_index.scan.assert_called_once_with(['/wp'], False)
+
+    def test_pre_render(self):
+        with mock.patch.object(
+                Service.WallpaperMerger, 'merge_wallpapers_cached',
+                return_value='/cache/merged.png'
+        ) as merge_wallpapers_cached, mock.patch.object(
+                Service.WallpaperMerger, 'apply_wallpapers'
+        ) as apply_wallpapers:
+            invocation = self.call('PreRender')
+        self.assertEqual(invocation.value.unpack(), ('/cache/merged.png',))
+        merge_wallpapers_cached.assert_called_once()
+        # doesn't change the desktop wallpaper
+        apply_wallpapers.assert_not_called()
+
+    def test_unknown_method(self):
+        invocation = self.call('Explode')
+        self.assertEqual(
+            invocation.error[0], 'org.freedesktop.DBus.Error.UnknownMethod'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+    from PIL import Image, ImageDraw
+    from hydrapaper import wallpaper_merger as WallpaperMerger
+    from hydrapaper import monitor_parser as MonitorParser
+except ImportError:  # needs numpy, Pillow and PyGObject
+    WallpaperMerger = None
+
+
+def make_monitors(tmp_dir):
+    # mixed scaling and sizes, so that tiles get fitted differently
+    monitors = [
+        MonitorParser.Monitor(320, 200, 1, 0, 0, 0, 'DP-1', True),
+        MonitorParser.Monitor(160, 120, 2, 320, 0, 1, 'DP-2', False),
+        MonitorParser.Monitor(200, 300, 1, 640, 40, 2, 'HDMI-1', False)
+    ]
+    colors = ((200, 40, 40), (30, 160, 60), (20, 40, 220))
+    for m, color, size in zip(monitors, colors, ((800, 450), (640, 640), (500, 900))):
+        image = Image.new('RGB', size, color)
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((size[0] // 4, size[1] // 4, size[0] // 2, size[1] // 2), fill=(250, 250, 250))
+        draw.line((0, 0, size[0], size[1]), fill=(0, 0, 0), width=5)
+        m.wallpaper = '{0}/{1}.png'.format(tmp_dir, m.name)
+        image.save(m.wallpaper)
+    return monitors
+
+
+@unittest.skipIf(WallpaperMerger is None, 'numpy, Pillow or PyGObject not available')
+class MergeBackendsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.monitors = make_monitors(self.tmp_dir)
+
+    def merge(self, backend, output_format='png', **kwargs):
+        save_path = '{0}/merged_{1}.{2}'.format(
+            self.tmp_dir, backend,
+            WallpaperMerger.OUTPUT_EXTENSIONS[output_format]
+        )
+        WallpaperMerger.multi_setup_pillow(
+            self.monitors, save_path, backend=backend,
+            output_format=output_format, **kwargs
+        )
+        with Image.open(save_path) as image:
+            image.load()
+            return image
+
+    def assert_same_image(self, a, b):
+        self.assertEqual(a.size, b.size)
+        self.assertEqual(a.mode, b.mode)
+        self.assertEqual(a.tobytes(), b.tobytes())
+
+    def test_numpy_matches_pillow(self):
+        for quality in WallpaperMerger.MERGE_QUALITIES:
+            for low_memory in (False, True):
+                with self.subTest(quality=quality, low_memory=low_memory):
+                    self.assert_same_image(
+                        self.merge(
+                            WallpaperMerger.MERGE_BACKEND_PILLOW,
+                            quality=quality, low_memory=low_memory
+                        ),
+                        self.merge(
+                            WallpaperMerger.MERGE_BACKEND_NUMPY,
+                            quality=quality, low_memory=low_memory
+                        )
+                    )
+
+    def test_numpy_matches_pillow_mapped_canvas(self):
+        # these encoders get the canvas as mapped RGBX, without a copy
+        for output_format in WallpaperMerger.RGBX_OUTPUT_FORMATS:
+            with self.subTest(output_format=output_format):
+                self.assert_same_image(
+                    self.merge(
+                        WallpaperMerger.MERGE_BACKEND_PILLOW,
+                        output_format=output_format
+                    ),
+                    self.merge(
+                        WallpaperMerger.MERGE_BACKEND_NUMPY,
+                        output_format=output_format
+                    )
+                )
+
+    def test_match_colors_is_off_by_default(self):
+        self.assert_same_image(
+            self.merge(WallpaperMerger.MERGE_BACKEND_NUMPY),
+            self.merge(WallpaperMerger.MERGE_BACKEND_NUMPY, match_colors=False)
+        )
+
+
+@unittest.skipIf(WallpaperMerger is None, 'numpy, Pillow or PyGObject not available')
+class MatchColorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.monitors = [
+            MonitorParser.Monitor(64, 32, 1, 0, 0, 0, 'DP-1', True),
+            MonitorParser.Monitor(64, 32, 1, 64, 0, 1, 'DP-2', False)
+        ]
+
+    def get_means(self, canvas):
+        return [
+            canvas[:, m.offset_x:m.offset_x + m.width].reshape(-1, 3).mean(axis=0)
+            for m in self.monitors
+        ]
+
+    def test_evens_out_colors(self):
+        canvas = numpy.zeros((32, 128, 3), numpy.uint8)
+        canvas[:, :64] = (100, 100, 100)
+        canvas[:, 64:] = (120, 100, 80)
+        before = self.get_means(canvas)
+        WallpaperMerger.match_colors_numpy(canvas, self.monitors)
+        after = self.get_means(canvas)
+        self.assertLess(
+            numpy.abs(after[0] - after[1]).max(),
+            numpy.abs(before[0] - before[1]).max()
+        )
+        numpy.testing.assert_allclose(after[0], after[1], atol=1)
+
+    def test_gains_are_clamped(self):
+        canvas = numpy.zeros((32, 128, 3), numpy.uint8)
+        canvas[:, :64] = 10
+        canvas[:, 64:] = 250
+        WallpaperMerger.match_colors_numpy(canvas, self.monitors)
+        max_gain = WallpaperMerger.COLOR_MATCH_MAX_GAIN
+        self.assertEqual(int(canvas[0, 0, 0]), int(10 * max_gain + 0.5))
+        self.assertEqual(int(canvas[0, 64, 0]), int(250 / max_gain + 0.5))
+
+    def test_same_colors_unchanged(self):
+        canvas = numpy.full((32, 128, 3), 123, numpy.uint8)
+        WallpaperMerger.match_colors_numpy(canvas, self.monitors)
+        self.assertTrue((canvas == 123).all())
+
+
+if __name__ == '__main__':
+    unittest.main()